@@ -11,7 +11,9 @@ from __future__ import absolute_import
 
 import os
 
+from billiard.process import current_process
 from celery import Celery
+from celery.signals import worker_process_init
 
 from django.conf import settings
 
@@ -32,6 +34,10 @@ app.conf.update({
     'CELERY_RESULT_BACKEND': CELERY_BROKER_URL,
     'CELERY_SEND_EVENTS': False,
     'CELERY_EVENT_QUEUE_EXPIRES': 60,
+    # Unrouted tasks are background work. Workers reserve one task at a time
+    # so interactive syncs aren't stuck behind prefetched bulk ones.
+    'CELERY_DEFAULT_QUEUE': settings.SYNC_BULK_QUEUE,
+    'CELERYD_PREFETCH_MULTIPLIER': 1,
 })
 
 
@@ -41,6 +47,17 @@ app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 
+@worker_process_init.connect
+def serve_metrics(**kwargs):
+    """
+    Serve each pool process's sync metrics on its own port.
+    """
+    if settings.METRICS_PORT:
+        from datauploader.metrics import start_http_server
+        index = getattr(current_process(), 'index', 0) or 0
+        start_http_server(settings.METRICS_PORT + index)
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
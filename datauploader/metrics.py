@@ -0,0 +1,254 @@
+"""
+Timings and counts of the sync pipeline.
+
+Observations are kept per process. They can be read in the Prometheus text
+format, from `render()` or over HTTP once `start_http_server()` runs (see
+METRICS_PORT), and are also pushed to statsd as they happen when
+STATSD_HOST is set.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import bisect
+import logging
+import socket
+import socketserver
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                 10000, 50000)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+ITEM_BYTES_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+# name: (help, label names, buckets)
+HISTOGRAMS = {
+    'jawbone_sync_stage_seconds': (
+        'Time spent in each stage of a sync.',
+        ('stage', 'endpoint'), SECONDS_BUCKETS),
+    'jawbone_sync_pages': (
+        'Jawbone pages fetched per member and endpoint.',
+        ('endpoint',), COUNT_BUCKETS),
+    'jawbone_sync_items': (
+        'Jawbone items fetched per member and endpoint.',
+        ('endpoint',), COUNT_BUCKETS),
+    'jawbone_sync_bytes': (
+        'Jawbone response bytes fetched per member and endpoint.',
+        ('endpoint',), BYTES_BUCKETS),
+    'jawbone_page_items': (
+        'Items per Jawbone page.',
+        ('endpoint',), COUNT_BUCKETS),
+    'jawbone_item_bytes': (
+        'Jawbone response bytes per item, by page.',
+        ('endpoint',), ITEM_BYTES_BUCKETS),
+}
+
+# name: (help, label names)
+COUNTERS = {
+    'jawbone_syncs_total': (
+        'Finished process_jawbone runs.', ('result',)),
+    'jawbone_requests_total': (
+        'Jawbone API requests by response status.', ('endpoint', 'status')),
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_statsd = None
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server only has this from Python 3.7.
+    daemon_threads = True
+
+
+def _label_values(label_names, labels):
+    return tuple(str(labels.get(name, '')) for name in label_names)
+
+
+def observe(name, value, **labels):
+    """
+    Record `value` in the histogram `name`.
+    """
+    _, label_names, buckets = HISTOGRAMS[name]
+    key = (name, _label_values(label_names, labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(buckets), 0, 0]
+        index = bisect.bisect_left(buckets, value)
+        if index < len(buckets):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    if name.endswith('_seconds'):
+        _push_statsd(name, key[1], value * 1000, 'ms')
+    else:
+        _push_statsd(name, key[1], value, 'h')
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add `amount` to the counter `name`.
+    """
+    _, label_names = COUNTERS[name]
+    key = (name, _label_values(label_names, labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _push_statsd(name, key[1], amount, 'c')
+
+
+@contextmanager
+def timer(stage, endpoint=''):
+    """
+    Time the enclosed block as a sync `stage`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('jawbone_sync_stage_seconds', time.perf_counter() - started,
+                stage=stage, endpoint=endpoint)
+
+
+class Stopwatch(object):
+    """
+    Add up the time spent in several separate spans.
+    """
+
+    def __init__(self):
+        self.seconds = 0
+
+    def iterate(self, iterable):
+        """
+        Yield from `iterable`, timing only how long items take to produce.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += time.perf_counter() - started
+            yield item
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_labels(label_names, label_values, **extra):
+    pairs = list(zip(label_names, label_values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = {key: (list(h[0]), h[1], h[2])
+                      for key, h in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, (help_text, label_names, buckets) in sorted(
+            HISTOGRAMS.items()):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (key_name, label_values), (counts, total, count) in sorted(
+                histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float('inf'),),
+                                           counts + [None]):
+                cumulative = count if bucket_count is None \
+                    else cumulative + bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(label_names, label_values,
+                                         le=_format_number(bound)),
+                    cumulative))
+            labels = _format_labels(label_names, label_values)
+            lines.append('{}_sum{} {}'.format(name, labels,
+                                              _format_number(total)))
+            lines.append('{}_count{} {}'.format(name, labels, count))
+    for name, (help_text, label_names) in sorted(COUNTERS.items()):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for (key_name, label_values), value in sorted(counters.items()):
+            if key_name == name:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(label_names, label_values),
+                    _format_number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _push_statsd(name, label_values, value, metric_type):
+    """
+    Send one observation to statsd, with label values as name segments.
+    """
+    global _statsd
+    if not settings.STATSD_HOST:
+        return
+    segments = [settings.STATSD_PREFIX, name] + [
+        label.replace('.', '_').replace(':', '_') or 'none'
+        for label in label_values]
+    line = '{}:{}|{}'.format('.'.join(segments), value, metric_type)
+    try:
+        if _statsd is None:
+            _statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _statsd.sendto(line.encode('utf-8'),
+                       (settings.STATSD_HOST, settings.STATSD_PORT))
+    except OSError:
+        logger.debug('could not send {} to statsd'.format(name))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, address=''):
+    """
+    Serve render() at /metrics on `port` from a daemon thread.
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('serving metrics on port {}'.format(server.server_port))
+    return server
@@ -4,22 +4,42 @@ These tasks:
   1. delete any current files in OH if they match the planned upload filename
   2. adds a data file
 """
+import codecs
+import hashlib
+import io
 import logging
 import json
+import itertools
 import tempfile
-import requests
 import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from celery import shared_task
 from django.conf import settings
+from django.core.cache import cache
 from open_humans.models import OpenHumansMember
+from open_humans.direct_sharing import delete_file, upload_stream
+from main.http import jawbone_session, openhumans_session
+from main.helpers import get_jawbone_files, invalidate_jawbone_files
+from main.models import EndpointSync
 from datetime import datetime
-from ohapi import api
+from requests_respectful import (RespectfulRequester,
+                                 RequestsRespectfulRateLimitedError)
+from datauploader import metrics
+import arrow
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Set up logging.
 logger = logging.getLogger(__name__)
 
-JAWBONE_API_BASE = 'https://jawbone.com'
-
 JAWBONE_ENDPOINTS = {
     'heartrates': '/nudge/api/v.1.1/users/@me/heartrates',
     'moves': '/nudge/api/v.1.1/users/@me/moves',
@@ -28,45 +48,742 @@ JAWBONE_ENDPOINTS = {
 
 DISALLOWED_DATA = ['place_lat', 'place_lon', 'place_acc', 'place_name']
 
+# Flattened time-series fields of the optional columnar (.npz) export, as
+# (column, dotted path in an item, NumPy dtype). Missing integers are
+# stored as 0, missing floats as NaN.
+JAWBONE_COLUMNS = {
+    'heartrates': [
+        ('xid', 'xid', 'U'),
+        ('date', 'date', 'int32'),
+        ('time_created', 'time_created', 'int64'),
+        ('resting_heartrate', 'resting_heartrate', 'float32'),
+    ],
+    'moves': [
+        ('xid', 'xid', 'U'),
+        ('date', 'date', 'int32'),
+        ('time_created', 'time_created', 'int64'),
+        ('time_completed', 'time_completed', 'int64'),
+        ('steps', 'details.steps', 'float32'),
+        ('distance', 'details.distance', 'float32'),
+        ('calories', 'details.calories', 'float32'),
+        ('bmr_day', 'details.bmr_day', 'float32'),
+        ('active_time', 'details.active_time', 'float32'),
+        ('inactive_time', 'details.inactive_time', 'float32'),
+    ],
+    'sleeps': [
+        ('xid', 'xid', 'U'),
+        ('date', 'date', 'int32'),
+        ('time_created', 'time_created', 'int64'),
+        ('time_completed', 'time_completed', 'int64'),
+        ('duration', 'details.duration', 'float32'),
+        ('light', 'details.light', 'float32'),
+        ('deep', 'details.sound', 'float32'),
+        ('awake', 'details.awake', 'float32'),
+        ('awakenings', 'details.awakenings', 'float32'),
+        ('quality', 'details.quality', 'float32'),
+    ],
+}
+
+# Bytes read at a time when downloading files from Open Humans.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# EndpointSync fields that sync_endpoint reads and updates.
+SYNC_STATE_FIELDS = ('watermark', 'content_hash', 'partitions')
+
+# All Jawbone API calls share the JAWBONE_RATE_LIMIT_REALM realm registered
+# in settings.
+rr = RespectfulRequester()
 
-@shared_task
-def process_jawbone(oh_id):
+
+@shared_task(bind=True)
+def process_jawbone(self, oh_id):
     """
-    Update the Jawbone file for a given OH user
+    Update the Jawbone file for a given OH user.
+    If the Jawbone rate limit won't free up within JAWBONE_MAX_RATE_WAIT
+    seconds the task is retried once it does, instead of blocking.
     """
+    if not start_sync(oh_id, self.request.id):
+        logger.debug('skipping sync {} of {}: superseded or already '
+                     'running'.format(self.request.id, oh_id))
+        metrics.increment('jawbone_syncs_total', result='skipped')
+        return
     logger.debug('Starting Jawbone processing for {}'.format(oh_id))
-    oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
-    oh_access_token = oh_member.get_access_token(
+    retrying = False
+    result = 'error'
+    try:
+        oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+        # Uploads and file listings use oh_member.access_token, which this
+        # keeps fresh.
+        with metrics.timer('oh_token'):
+            oh_member.get_access_token(
                             client_id=settings.OPENHUMANS_CLIENT_ID,
                             client_secret=settings.OPENHUMANS_CLIENT_SECRET)
-    jawbone_member = oh_member.datasourcemember
-    jawbone_access_token = jawbone_member.get_access_token(
+        jawbone_member = oh_member.datasourcemember
+        with metrics.timer('jawbone_token'):
+            jawbone_access_token = jawbone_member.get_access_token(
                             client_id=settings.JAWBONE_CLIENT_ID,
                             client_secret=settings.JAWBONE_CLIENT_SECRET)
-    update_jawbone(oh_member, jawbone_access_token)
+        update_jawbone(oh_member, jawbone_access_token)
+        result = 'ok'
+    except RequestsRespectfulRateLimitedError as e:
+        if self.request.retries >= self.max_retries:
+            raise
+        logger.debug('rate-limited, retrying {} in {}s'.format(
+            oh_id, e.retry_after))
+        # The retry is the same sync, so it keeps the member's lease.
+        retrying = True
+        result = 'retry'
+        raise self.retry(exc=e, countdown=e.retry_after)
+    except JawboneFetchError as e:
+        if not e.transient or self.request.retries >= self.max_retries:
+            raise
+        logger.debug('Jawbone answered {}, retrying {} in {}s'.format(
+            e.status_code, oh_id, settings.JAWBONE_FETCH_RETRY_DELAY))
+        # Pages fetched before the error are kept (see PageCheckpoint).
+        retrying = True
+        result = 'retry'
+        raise self.retry(exc=e, countdown=settings.JAWBONE_FETCH_RETRY_DELAY)
+    except FileListingError as e:
+        if self.request.retries >= self.max_retries:
+            raise
+        logger.debug('{}, retrying in {}s'.format(
+            e, settings.JAWBONE_FETCH_RETRY_DELAY))
+        retrying = True
+        result = 'retry'
+        raise self.retry(exc=e, countdown=settings.JAWBONE_FETCH_RETRY_DELAY)
+    finally:
+        metrics.increment('jawbone_syncs_total', result=result)
+        if not retrying:
+            release_sync_lease(oh_id)
+
+
+def sync_lease_key(oh_id):
+    return 'jawbone-sync-lease:{}'.format(oh_id)
+
+
+def sync_running_key(oh_id):
+    return 'jawbone-sync-running:{}'.format(oh_id)
+
+
+def sync_superseded_key(task_id):
+    return 'jawbone-sync-superseded:{}'.format(task_id)
+
+
+def acquire_sync_lease(oh_id, queue=None, task_id=None):
+    """
+    Take the lease that lets one sync per member be queued or running,
+    recording the queue and id of its task. Return False if another sync
+    holds it.
+    """
+    return cache.add(sync_lease_key(oh_id), {'queue': queue,
+                                             'task_id': task_id},
+                     settings.SYNC_LEASE_TTL)
+
+
+def release_sync_lease(oh_id):
+    cache.delete_many([sync_lease_key(oh_id), sync_running_key(oh_id)])
+
+
+def start_sync(oh_id, task_id):
+    """
+    Mark the sync task `task_id` of a member as running. Return False if
+    it was superseded while queued or another sync of the member is
+    running. Retries of a task keep its id, so they may carry on.
+    """
+    if cache.get(sync_superseded_key(task_id)):
+        return False
+    running_key = sync_running_key(oh_id)
+    return (cache.add(running_key, task_id, settings.SYNC_LEASE_TTL) or
+            cache.get(running_key) == task_id)
+
+
+def queue_jawbone_sync(oh_id, interactive=False, **options):
+    """
+    Queue process_jawbone for a member. Syncs a member asked for go to the
+    interactive queue, scheduled refreshes to the bulk queue.
+
+    Return None without queueing if a sync of the member is already queued
+    or running; the request is coalesced into that one. The exception is a
+    member asking for a sync while a scheduled one still waits on the bulk
+    queue: that one is superseded by a sync on the interactive queue.
+    """
+    if interactive:
+        queue = settings.SYNC_INTERACTIVE_QUEUE
+    else:
+        queue = settings.SYNC_BULK_QUEUE
+    task_id = str(uuid.uuid4())
+    if not acquire_sync_lease(oh_id, queue=queue, task_id=task_id):
+        held = cache.get(sync_lease_key(oh_id))
+        if not (interactive and isinstance(held, dict) and
+                held['queue'] == settings.SYNC_BULK_QUEUE and
+                cache.get(sync_running_key(oh_id)) is None):
+            logger.debug('sync of {} already in flight'.format(oh_id))
+            return None
+        logger.debug('moving the sync of {} to the {} queue'.format(
+            oh_id, queue))
+        cache.set(sync_superseded_key(held['task_id']), True,
+                  settings.SYNC_LEASE_TTL)
+        cache.set(sync_lease_key(oh_id), {'queue': queue, 'task_id': task_id},
+                  settings.SYNC_LEASE_TTL)
+    return process_jawbone.apply_async(args=[oh_id], queue=queue,
+                                       task_id=task_id, **options)
+
+
+def compile_cleaner(disallowed):
+    """
+    Build a function that cleans a whole page of items at once.
+
+    Keys in `disallowed` are removed from every item; dotted keys such as
+    'details.place_name' reach into nested dicts. The page is handled a
+    column at a time: items are shallow-copied, then each disallowed key is
+    popped across the page, and nested dicts are cleaned as a column of
+    their own. Key order and the input items are left untouched.
+    """
+    top_level = []
+    nested = {}
+    for key in disallowed:
+        head, _, rest = key.partition('.')
+        if rest:
+            nested.setdefault(head, []).append(rest)
+        elif head not in top_level:
+            top_level.append(head)
+    nested_cleaners = [(head, compile_cleaner(rest))
+                       for head, rest in nested.items()
+                       if head not in top_level]
+
+    def clean_page(items):
+        cleaned = [item.copy() for item in items]
+        for key in top_level:
+            for item in cleaned:
+                item.pop(key, None)
+        for head, clean_nested in nested_cleaners:
+            column = [item for item in cleaned
+                      if isinstance(item.get(head), dict)]
+            values = clean_nested([item[head] for item in column])
+            for item, value in zip(column, values):
+                item[head] = value
+        return cleaned
+
+    return clean_page
+
+
+# Compiled once at import; endpoints may diverge from DISALLOWED_DATA here.
+clean_page = compile_cleaner(DISALLOWED_DATA)
+JAWBONE_CLEANERS = {endpoint: clean_page for endpoint in JAWBONE_ENDPOINTS}
+
+
+def iter_clean_data(pages, cleaner=clean_page, endpoint=''):
+    """
+    Clean each page as it arrives and yield its items one at a time.
+    Pages that are already clean are passed with `cleaner=None`.
+    """
+    for items in pages:
+        if cleaner is not None:
+            with metrics.timer('clean', endpoint):
+                items = cleaner(items)
+        for item in items:
+            yield item
 
 
 def clean_data(data):
-    cleaned_data = []
+    return list(iter_clean_data([data]))
+
+
+def merge_data(new_data, old_data):
+    """
+    Merge newly fetched items into previously uploaded ones by `xid`.
+
+    New items come first (Jawbone returns newest first) and replace any
+    older copy of the same item. Both can be streams; only the new `xid`s
+    are held in memory.
+    """
+    new_xids = set()
+    for item in new_data:
+        new_xids.add(item.get('xid'))
+        yield item
+    for item in old_data:
+        if item.get('xid') not in new_xids:
+            yield item
+
+
+def track_watermark(data, state):
+    """
+    Pass items through, recording the newest `time_updated` in `state`.
+    """
     for item in data:
-        cleaned_item = {x: item[x] for x in item if x not in DISALLOWED_DATA}
-        cleaned_data.append(cleaned_item)
-    return(cleaned_data)
+        state['watermark'] = max(state['watermark'],
+                                 item.get('time_updated') or 0)
+        yield item
 
 
 def update_jawbone(oh_member, jawbone_access_token):
+    """
+    Sync all Jawbone endpoints of a member concurrently.
+
+    Endpoints run in a thread pool of JAWBONE_ENDPOINT_CONCURRENCY workers
+    and share the "jawbone" rate-limit realm. Only the calling thread
+    touches the database: workers list and upload files with
+    `oh_member.access_token`, which the caller keeps fresh.
+    """
+    jawbone_member = oh_member.datasourcemember
+    syncs = {}
     for endpoint in JAWBONE_ENDPOINTS.keys():
-        data = get_aggregate_jawbone_data(
+        syncs[endpoint], _ = EndpointSync.objects.get_or_create(
+            member=jawbone_member, endpoint=endpoint)
+    states = {endpoint: {field: getattr(sync, field)
+                         for field in SYNC_STATE_FIELDS}
+              for endpoint, sync in syncs.items()}
+    listing = []
+    listing_lock = threading.Lock()
+
+    def existing_files():
+        # Only list the member's files once an endpoint needs them.
+        with listing_lock:
+            if not listing:
+                listing.append(get_jawbone_files(
+                    oh_member, oh_access_token=oh_member.access_token))
+            if listing[0] == 'error':
+                raise FileListingError(oh_member.oh_id)
+            return listing[0]
+
+    with ThreadPoolExecutor(
+            max_workers=settings.JAWBONE_ENDPOINT_CONCURRENCY) as executor:
+        futures = {
+            endpoint: executor.submit(
+                sync_endpoint, oh_member=oh_member,
+                jawbone_access_token=jawbone_access_token,
+                endpoint=endpoint, state=dict(states[endpoint]),
+                existing_files=existing_files)
+            for endpoint in syncs}
+    # Keep the progress of the endpoints that succeeded even if one failed.
+    error = None
+    for endpoint, future in futures.items():
+        try:
+            state = future.result()
+        except Exception as e:
+            logger.exception('syncing {} failed for {}'.format(
+                endpoint, oh_member.oh_id))
+            error = error or e
+            continue
+        if state != states[endpoint]:
+            for field, value in state.items():
+                setattr(syncs[endpoint], field, value)
+            syncs[endpoint].save()
+    if error:
+        raise error
+    jawbone_member.last_updated = arrow.now().format()
+    jawbone_member.save(update_fields=['last_updated'])
+
+
+def sync_endpoint(oh_member, jawbone_access_token, endpoint, state,
+                  existing_files):
+    """
+    Fetch and upload new data of one endpoint.
+    Take and return the endpoint's sync state (see SYNC_STATE_FIELDS).
+    `existing_files` returns the member's files on Open Humans (see
+    get_jawbone_files), or raises FileListingError if they can't be listed;
+    it is only called if there is new data to merge.
+    """
+    if settings.JAWBONE_PARTITIONED_FILES:
+        return sync_partitioned_endpoint(
+            oh_member, jawbone_access_token, endpoint, state, existing_files)
+    partitions = json.loads(state['partitions'] or '{}')
+    watermark = state['watermark']
+    if partitions:
+        # Switching from monthly files.
+        logger.debug('no existing {} file for {}, full sync'.format(
+            endpoint, oh_member.oh_id))
+        watermark = 0
+    old_data = []
+    fetched = Counter()
+    checkpoint = page_checkpoint(oh_member, endpoint)
+
+    def fetch(updated_after):
+        return iter_clean_data(fetch_jawbone_pages(
             access_token=jawbone_access_token,
-            endpoint=endpoint)
-        data = clean_data(data)
-        if data:
-            add_jawbone_data(oh_member=oh_member, data=data, endpoint=endpoint)
+            endpoint=endpoint,
+            updated_after=updated_after, stats=fetched,
+            checkpoint=checkpoint),
+            cleaner=page_cleaner(endpoint, checkpoint), endpoint=endpoint)
+
+    data = fetch(watermark)
+    first_item = next(data, None)
+    if first_item is not None and watermark:
+        old_data = get_existing_jawbone_data(existing_files(), endpoint)
+        if old_data is None:
+            # Without the uploaded file there is nothing to merge into.
+            logger.debug('no existing {} file for {}, full sync'.format(
+                endpoint, oh_member.oh_id))
+            watermark = 0
+            old_data = []
+            data = fetch(watermark)
+            first_item = next(data, None)
+    state['watermark'] = watermark
+    if first_item is not None:
+        data = track_watermark(itertools.chain([first_item], data), state)
+        data = merge_data(data, old_data)
+        state['content_hash'] = add_jawbone_data(
+            oh_member=oh_member, data=data, endpoint=endpoint,
+            content_hash=state['content_hash'])
+    if partitions:
+        delete_monthly_files(oh_member, endpoint, partitions)
+        state['partitions'] = '{}'
+    record_fetched(endpoint, fetched)
+    if checkpoint:
+        checkpoint.clear()
+    return state
+
+
+def record_fetched(endpoint, fetched):
+    """
+    Record the pages, items and bytes fetched for one member's endpoint.
+    """
+    for field in ('pages', 'items', 'bytes'):
+        metrics.observe('jawbone_sync_{}'.format(field), fetched[field],
+                        endpoint=endpoint)
+
+
+def sync_partitioned_endpoint(oh_member, jawbone_access_token, endpoint,
+                              state, existing_files):
+    """
+    Like sync_endpoint, but keep the data of the endpoint in one file per
+    month plus a manifest listing them. New items are spooled to disk by
+    month and only the months they fall into are merged and rewritten.
+    """
+    partitions = json.loads(state['partitions'] or '{}')
+    watermark = state['watermark']
+    if watermark and not partitions:
+        # Switching from a single file.
+        logger.debug('no existing {} partitions for {}, full sync'.format(
+            endpoint, oh_member.oh_id))
+        watermark = 0
+    fetched = Counter()
+    checkpoint = page_checkpoint(oh_member, endpoint)
+
+    def spool(updated_after, directory):
+        state['watermark'] = updated_after
+        return spool_partitions(track_watermark(iter_clean_data(
+            fetch_jawbone_pages(
+                access_token=jawbone_access_token, endpoint=endpoint,
+                updated_after=updated_after, stats=fetched,
+                checkpoint=checkpoint),
+            cleaner=page_cleaner(endpoint, checkpoint), endpoint=endpoint),
+            state), directory)
+
+    with tempfile.TemporaryDirectory() as spool_directory:
+        spooled = spool(watermark, spool_directory)
+        if spooled and watermark:
+            # Only look for the monthly files once there is data to merge.
+            existing_files = existing_files()
+            uploaded = {f['name'] for f in existing_files}
+            if not all(jawbone_basename(endpoint, partition) in uploaded
+                       for partition in partitions):
+                logger.debug('{} partitions of {} have gone, full '
+                             'sync'.format(endpoint, oh_member.oh_id))
+                watermark = 0
+                spooled = spool(watermark, spool_directory)
+        record_fetched(endpoint, fetched)
+        if not spooled:
+            if checkpoint:
+                checkpoint.clear()
+            return state
+        new_partitions = dict(partitions) if watermark else {}
+        for partition, path in sorted(spooled.items()):
+            old_data = []
+            if watermark and partition in partitions:
+                old_data = get_existing_jawbone_data(
+                    existing_files, endpoint, partition)
+                if old_data is None:
+                    raise Exception('could not fetch {} for {}'.format(
+                        jawbone_basename(endpoint, partition),
+                        oh_member.oh_id))
+            new_partitions[partition] = add_jawbone_data(
+                oh_member=oh_member,
+                data=merge_data(iter_spooled(path), old_data),
+                endpoint=endpoint, partition=partition,
+                # A full sync uploads every month, in case some have gone.
+                content_hash=partitions.get(partition) if watermark else None)
+        if not watermark:
+            for partition in set(partitions) - set(new_partitions):
+                delete_partition(oh_member, endpoint, partition)
+            if state['content_hash']:
+                delete_partition(oh_member, endpoint, None)
+                state['content_hash'] = ''
+        if new_partitions != partitions:
+            upload_manifest(oh_member, endpoint, new_partitions)
+            invalidate_jawbone_files(oh_member.oh_id)
+    if checkpoint:
+        checkpoint.clear()
+    state['partitions'] = json.dumps(new_partitions, sort_keys=True)
+    return state
+
+
+def partition_of(item):
+    """
+    Return the month ('YYYY-MM') an item belongs to, from its `date`
+    (YYYYMMDD) or else its `time_created`.
+    """
+    date = item.get('date')
+    if isinstance(date, int) and 10000101 <= date <= 99991231:
+        return '{:04d}-{:02d}'.format(date // 10000, date // 100 % 100)
+    time_created = item.get('time_created')
+    if isinstance(time_created, (int, float)):
+        return arrow.get(time_created).format('YYYY-MM')
+    return 'undated'
+
+
+def spool_partitions(data, directory):
+    """
+    Write items to one JSON-lines file per partition in `directory`,
+    keeping their order. Return the file paths by partition.
+    """
+    paths = {}
+    spools = {}
+    try:
+        for item in data:
+            partition = partition_of(item)
+            spool = spools.get(partition)
+            if spool is None:
+                paths[partition] = os.path.join(
+                    directory, '{}.jsonl'.format(partition))
+                spool = spools[partition] = open(paths[partition], 'w')
+            spool.write(json.dumps(item))
+            spool.write('\n')
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return paths
+
+
+def iter_spooled(path):
+    with open(path) as spool:
+        for line in spool:
+            yield json.loads(line)
+
+
+def delete_partition(oh_member, endpoint, partition):
+    """
+    Delete the files of one partition (or of the single-file layout).
+    """
+    for extension in ('json', 'npz'):
+        with metrics.timer('delete', endpoint):
+            delete_file(oh_member.access_token,
+                        oh_member.oh_id,
+                        file_basename=jawbone_basename(
+                            endpoint, partition, extension))
+
+
+def delete_monthly_files(oh_member, endpoint, partitions):
+    """
+    Delete the monthly files of an endpoint and their manifest.
+    """
+    for partition in partitions:
+        delete_partition(oh_member, endpoint, partition)
+    with metrics.timer('delete', endpoint):
+        delete_file(oh_member.access_token,
+                    oh_member.oh_id,
+                    file_basename=manifest_basename(endpoint))
+    invalidate_jawbone_files(oh_member.oh_id)
+
+
+def manifest_basename(endpoint):
+    return 'jawbone-{}-manifest.json'.format(endpoint)
+
+
+def upload_manifest(oh_member, endpoint, partitions):
+    """
+    Replace the manifest listing the monthly files of an endpoint.
+    """
+    basename = manifest_basename(endpoint)
+    manifest = {
+        'endpoint': endpoint,
+        'updated_at': str(datetime.utcnow()),
+        'partitions': [{
+            'partition': partition,
+            'file': jawbone_basename(endpoint, partition),
+            'sha256': content_hash,
+        } for partition, content_hash in sorted(partitions.items())],
+    }
+    metadata = {
+        'tags': ['Jawbone', 'manifest'],
+        'description': 'Index of the monthly Jawbone "{}" files'.format(
+            endpoint),
+        }
+    with metrics.timer('delete', endpoint):
+        delete_file(oh_member.access_token,
+                    oh_member.oh_id,
+                    file_basename=basename)
+    with metrics.timer('upload', endpoint):
+        upload_stream(io.BytesIO(json.dumps(manifest).encode('utf-8')),
+                      basename, metadata, oh_member.access_token,
+                      project_member_id=oh_member.oh_id)
+
+
+def jawbone_basename(endpoint, partition=None, extension='json'):
+    if partition:
+        return 'jawbone-{}-{}.{}'.format(endpoint, partition, extension)
+    return 'jawbone-{}-data.{}'.format(endpoint, extension)
+
+
+def get_existing_jawbone_data(existing_files, endpoint, partition=None):
+    """
+    Return the items of the data file of an endpoint (or one of its
+    partitions) that is already on Open Humans, or None if it isn't listed.
+    The file is downloaded and decoded as the items are read.
+    """
+    basename = jawbone_basename(endpoint, partition)
+    for existing_file in existing_files:
+        if existing_file['name'] == basename:
+            return iter_download(existing_file['url'], basename, endpoint)
+    return None
+
+
+def iter_download(url, basename, endpoint):
+    """
+    Yield the items of a JSON array file as it is downloaded.
+    """
+    with metrics.timer('download', endpoint):
+        req = openhumans_session().get(url, stream=True)
+    try:
+        if req.status_code != 200:
+            raise Exception('could not download {} (HTTP {})'.format(
+                basename, req.status_code))
+        yield from iter_json_array_items(codecs.iterdecode(
+            req.iter_content(DOWNLOAD_CHUNK_SIZE), 'utf-8'))
+    finally:
+        req.close()
+
+
+def iter_json_array_items(chunks):
+    """
+    Decode a JSON array from an iterable of text chunks, yielding one
+    element at a time. Only the element being decoded is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    exhausted = False
+    # What may come next: '[', 'value or ]', 'value' or ', or ]'.
+    expected = '['
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == '[':
+                if char != '[':
+                    raise ValueError('not a JSON array')
+                position += 1
+                expected = 'value or ]'
+                continue
+            if char == ']' and expected in ('value or ]', ', or ]'):
+                return
+            if expected == ', or ]':
+                if char != ',':
+                    raise ValueError('invalid JSON array')
+                position += 1
+                expected = 'value'
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+            # A value is only complete once the separator after it is
+            # read: a number may go on in the next chunk.
+            if end is not None:
+                after = JSON_WHITESPACE.match(buffer, end).end()
+            if end is not None and (
+                    exhausted or buffer[after:after + 1] in (',', ']')):
+                yield item
+                position = end
+                expected = ', or ]'
+                continue
+        if exhausted:
+            raise ValueError('invalid or truncated JSON array')
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def iter_json_array(data):
+    """
+    Encode an iterable as a JSON array, yielding one element at a time.
+    The output is byte-identical to `json.dumps(list(data))`.
+    """
+    encoder = json.JSONEncoder()
+    yield '['
+    for i, item in enumerate(data):
+        if i:
+            yield ', '
+        yield encoder.encode(item)
+    yield ']'
+
 
+def write_json_array(data, json_file):
+    for chunk in iter_json_array(data):
+        json_file.write(chunk)
 
-def add_jawbone_data(oh_member, data, endpoint):
-    # delete old file and upload new to open humans
-    tmp_directory = tempfile.mkdtemp()
+
+def columnar_export_enabled():
+    if not settings.JAWBONE_COLUMNAR_EXPORT:
+        return False
+    if np is None:
+        logger.warning('JAWBONE_COLUMNAR_EXPORT is set but NumPy is '
+                       'not installed, skipping the .npz export')
+        return False
+    return True
+
+
+def collect_columns(data, columns, values):
+    """
+    Pass `data` through unchanged while appending the fields listed in
+    `columns` to the lists in `values`, keyed by column name.
+    """
+    paths = [(name, path.split('.')) for name, path, _ in columns]
+    for item in data:
+        for name, keys in paths:
+            value = item
+            for key in keys:
+                value = value.get(key) if isinstance(value, dict) else None
+            values[name].append(value)
+        yield item
+
+
+def write_npz(columns, values, npz_file):
+    """
+    Write collected column values as typed arrays to an .npz file.
+    Values of the wrong type are treated as missing.
+    """
+    arrays = {}
+    for name, _, dtype in columns:
+        if dtype == 'U':
+            fill, accepted = '', str
+        elif np.issubdtype(np.dtype(dtype), np.integer):
+            fill, accepted = 0, int
+        else:
+            fill, accepted = np.nan, (int, float)
+        arrays[name] = np.array(
+            [value if isinstance(value, accepted) and
+             not isinstance(value, bool) else fill
+             for value in values[name]], dtype=dtype)
+    np.savez_compressed(npz_file, **arrays)
+
+
+def add_jawbone_data(oh_member, data, endpoint, content_hash=None,
+                     partition=None):
+    """
+    Write the data file of an endpoint (or of one monthly `partition` of
+    it) and return its SHA-256. If that matches `content_hash` the data is
+    unchanged and the file on Open Humans is left alone; otherwise it is
+    replaced.
+    With JAWBONE_COLUMNAR_EXPORT the endpoint's JAWBONE_COLUMNS are also
+    uploaded in an .npz file of the same name.
+    """
     metadata = {
         'tags': ['Jawbone'],
         'updated_at': str(datetime.utcnow()),
@@ -83,42 +800,391 @@ def add_jawbone_data(oh_member, data, endpoint):
         metadata['description'] = ('Jawbone "heartrates" data, including '
                                    'resting heartrates')
         metadata['tags'].append('heartrate')
-    out_file = os.path.join(
-        tmp_directory,
-        'jawbone-{}-data.json'.format(endpoint))
-    logger.debug('deleted old file for {}'.format(oh_member.oh_id))
-    api.delete_file(oh_member.access_token,
-                    oh_member.oh_id,
-                    file_basename='jawbone-{}-data.json'.format(endpoint))
-    with open(out_file, 'w') as json_file:
-        json.dump(data, json_file)
-        json_file.flush()
-    api.upload_aws(out_file, metadata,
-                   oh_member.access_token,
-                   project_member_id=oh_member.oh_id)
+    if partition:
+        metadata['tags'].append(partition)
+        metadata['description'] = '{} for {}'.format(
+            metadata.get('description', 'Jawbone data'), partition)
+    basename = jawbone_basename(endpoint, partition)
+    sha256 = hashlib.sha256()
+    columns = None
+    if endpoint in JAWBONE_COLUMNS and columnar_export_enabled():
+        columns = JAWBONE_COLUMNS[endpoint]
+        column_values = defaultdict(list)
+        data = collect_columns(data, columns, column_values)
+        # Turning the export on changes the hash, so the .npz gets uploaded.
+        sha256.update(b'npz')
+    # `data` may be a lazy stream of Jawbone pages, so write it out in full
+    # before the old file is deleted. Files are kept in memory up to
+    # UPLOAD_SPOOL_SIZE bytes, and removed when closed.
+    with tempfile.SpooledTemporaryFile(
+            max_size=settings.UPLOAD_SPOOL_SIZE) as json_file:
+        # Fetching and cleaning are timed as they happen, so leave them out
+        # of the serialization time.
+        upstream = metrics.Stopwatch()
+        started = time.perf_counter()
+        for chunk in iter_json_array(upstream.iterate(data)):
+            chunk = chunk.encode('utf-8')
+            sha256.update(chunk)
+            json_file.write(chunk)
+        metrics.observe('jawbone_sync_stage_seconds',
+                        time.perf_counter() - started - upstream.seconds,
+                        stage='serialize', endpoint=endpoint)
+        if sha256.hexdigest() == content_hash:
+            logger.debug('jawbone {} data unchanged for {}'.format(
+                endpoint, oh_member.oh_id))
+            return content_hash
+        logger.debug('deleted old file for {}'.format(oh_member.oh_id))
+        with metrics.timer('delete', endpoint):
+            delete_file(oh_member.access_token,
+                        oh_member.oh_id,
+                        file_basename=basename)
+        json_file.seek(0)
+        with metrics.timer('upload', endpoint):
+            upload_stream(json_file, basename, metadata,
+                          oh_member.access_token,
+                          project_member_id=oh_member.oh_id)
+    if columns:
+        npz_basename = jawbone_basename(endpoint, partition, 'npz')
+        npz_metadata = dict(metadata, tags=metadata['tags'] + ['npz'])
+        npz_metadata['description'] = '{} (columnar NumPy arrays)'.format(
+            metadata.get('description', 'Jawbone data'))
+        with tempfile.SpooledTemporaryFile(
+                max_size=settings.UPLOAD_SPOOL_SIZE) as npz_file:
+            with metrics.timer('npz', endpoint):
+                write_npz(columns, column_values, npz_file)
+            with metrics.timer('delete', endpoint):
+                delete_file(oh_member.access_token,
+                            oh_member.oh_id,
+                            file_basename=npz_basename)
+            npz_file.seek(0)
+            with metrics.timer('upload', endpoint):
+                upload_stream(npz_file, npz_basename, npz_metadata,
+                              oh_member.access_token,
+                              project_member_id=oh_member.oh_id)
+    invalidate_jawbone_files(oh_member.oh_id)
     logger.debug('added new jawbone {} file for {}'.format(
         endpoint, oh_member.oh_id))
+    return sha256.hexdigest()
+
+
+class FileListingError(Exception):
+    """
+    Open Humans didn't list a member's files, so whether the data already
+    uploaded is there is unknown. Usually transient.
+    """
+
+    def __init__(self, oh_id):
+        super(FileListingError, self).__init__(oh_id)
+        self.oh_id = oh_id
+
+    def __str__(self):
+        return 'could not list the files of {}'.format(self.oh_id)
 
 
-def get_jawbone_data(access_token, url):
-    req = requests.get(url, headers={
-        'Authorization': 'Bearer {}'.format(access_token)})
+class JawboneFetchError(Exception):
+    """
+    Jawbone didn't answer a request for a page with one.
+    """
+
+    def __init__(self, url, status_code):
+        super(JawboneFetchError, self).__init__(url, status_code)
+        self.url = url
+        self.status_code = status_code
+
+    def __str__(self):
+        return 'no Jawbone page from {} (HTTP {})'.format(self.url,
+                                                          self.status_code)
+
+    @property
+    def transient(self):
+        return self.status_code == 429 or self.status_code >= 500
+
+
+def get_jawbone_data(access_token, url, params=None, endpoint='',
+                     stats=None, raise_errors=False):
+    """
+    Fetch one page of the Jawbone API, or None if it failed (or raise
+    JawboneFetchError if `raise_errors`). Pages, items and response bytes
+    are added to the `stats` counter if given.
+    """
+    with metrics.timer('page_fetch', endpoint):
+        req = rr.get(url, params=params, headers={
+            'Authorization': 'Bearer {}'.format(access_token)},
+            realms=[settings.JAWBONE_RATE_LIMIT_REALM], wait=True,
+            max_wait=settings.JAWBONE_MAX_RATE_WAIT,
+            session=jawbone_session())
+    metrics.increment('jawbone_requests_total', endpoint=endpoint,
+                      status=req.status_code)
+    if stats is not None:
+        stats['pages'] += 1
+        stats['bytes'] += len(req.content)
     if req.status_code == 200:
-        return req.json()
+        apidata = req.json()
+        items = apidata.get('data', {}).get('items')
+        if items:
+            metrics.observe('jawbone_page_items', len(items),
+                            endpoint=endpoint)
+            metrics.observe('jawbone_item_bytes',
+                            len(req.content) / len(items), endpoint=endpoint)
+            if stats is not None:
+                stats['items'] += len(items)
+        return apidata
+    elif raise_errors:
+        raise JawboneFetchError(url, req.status_code)
     else:
         return None
 
 
-def get_aggregate_jawbone_data(access_token, endpoint):
-    init_url = JAWBONE_API_BASE + JAWBONE_ENDPOINTS[endpoint]
-    apidata = get_jawbone_data(access_token=access_token, url=init_url)
-    agg_data = apidata['data']['items']
-    while 'links' in apidata['data'] and 'next' in apidata['data']['links']:
-        nexturl = JAWBONE_API_BASE + apidata['data']['links']['next']
-        apidata = get_jawbone_data(access_token=access_token, url=nexturl)
-        if apidata and 'data' in apidata and 'items' in apidata['data']:
-            agg_data = agg_data + apidata['data']['items']
-        else:
-            break
+class PageCheckpoint(object):
+    """
+    Pages of a member's endpoint fetched by a sync that hasn't finished.
+
+    They are kept in the cache for JAWBONE_PAGE_CHECKPOINT_TTL seconds, so
+    a retried sync continues after the last good page instead of spending
+    the rate limit on pages it already had. Only full fetches are kept:
+    incremental ones are a page or two and cheap to fetch again. Each query
+    (a full fetch or one of its time windows) has a head entry with the
+    number of pages kept and the `next` link after them; pages have their
+    own entries. Pages are cleaned before they are kept, so no disallowed
+    data is stored.
+    """
+
+    def __init__(self, oh_id, endpoint):
+        self.prefix = 'jawbone-pages:{}:{}'.format(oh_id, endpoint)
+        self.endpoint = endpoint
+        self.cleaner = JAWBONE_CLEANERS[endpoint]
+        self.lock = threading.Lock()
+        # Pages kept by head key, for the queries of this sync.
+        self.queries = {}
+
+    @staticmethod
+    def keeps(params):
+        return 'updated_after' not in params
+
+    def head_key(self, params):
+        return '{}:{}'.format(self.prefix, '&'.join(
+            '{}={}'.format(name, params[name]) for name in sorted(params)))
+
+    def resume(self, params):
+        """
+        Return the pages kept for the query `params` and the `next` link
+        after them. The link is None once the last page was reached.
+        """
+        if not self.keeps(params):
+            return [], None
+        key = self.head_key(params)
+        head = cache.get(key)
+        if not head:
+            return [], None
+        page_keys = ['{}:{}'.format(key, n) for n in range(head['pages'])]
+        pages = cache.get_many(page_keys)
+        if len(pages) < len(page_keys):
+            # Some pages were evicted; start over.
+            return [], None
+        with self.lock:
+            self.queries[key] = head['pages']
+        return [pages[page_key] for page_key in page_keys], head['next']
+
+    def save(self, params, items, next_link):
+        """
+        Keep the next page of the query `params`. Return its cleaned items.
+        """
+        key = self.head_key(params)
+        with metrics.timer('clean', self.endpoint):
+            items = self.cleaner(items)
+        if not self.keeps(params):
+            return items
+        with self.lock:
+            n = self.queries.get(key, 0)
+            self.queries[key] = n + 1
+        ttl = settings.JAWBONE_PAGE_CHECKPOINT_TTL
+        cache.set('{}:{}'.format(key, n), items, ttl)
+        cache.set(key, {'pages': n + 1, 'next': next_link}, ttl)
+        return items
+
+    def clear(self):
+        """
+        Forget the pages of this sync once its data is uploaded.
+        """
+        with self.lock:
+            queries = dict(self.queries)
+            self.queries.clear()
+        keys = []
+        for key, pages in queries.items():
+            keys.append(key)
+            keys.extend('{}:{}'.format(key, n) for n in range(pages))
+        cache.delete_many(keys)
+
+
+def page_checkpoint(oh_member, endpoint):
+    """
+    Return the PageCheckpoint of a member's endpoint, or None if
+    checkpoints are turned off.
+    """
+    if not settings.JAWBONE_PAGE_CHECKPOINT_TTL:
+        return None
+    return PageCheckpoint(oh_member.oh_id, endpoint)
+
+
+def page_cleaner(endpoint, checkpoint):
+    """
+    Return the cleaner for the pages of a sync, or None if `checkpoint`
+    already cleans them.
+    """
+    if checkpoint:
+        return None
+    return JAWBONE_CLEANERS[endpoint]
+
+
+def fetch_jawbone_pages(access_token, endpoint, updated_after=0, stats=None,
+                        checkpoint=None):
+    """
+    Yield the pages of an endpoint updated after `updated_after`. Full
+    syncs fetch time windows concurrently if JAWBONE_SHARDED_FETCH is set.
+    """
+    if not updated_after and settings.JAWBONE_SHARDED_FETCH:
+        return iter_jawbone_windows(access_token, endpoint, stats=stats,
+                                    checkpoint=checkpoint)
+    return iter_jawbone_pages(access_token, endpoint,
+                              updated_after=updated_after, stats=stats,
+                              checkpoint=checkpoint)
+
+
+def iter_jawbone_pages(access_token, endpoint, updated_after=0, stats=None,
+                       start_time=None, end_time=None, checkpoint=None):
+    """
+    Yield the items of each page of an endpoint as it arrives, asking for
+    pages of JAWBONE_PAGE_SIZES[endpoint] items. `start_time`/`end_time`
+    limit it to items created in that range (epoch seconds, inclusive).
+
+    Raise JawboneFetchError if a page can't be fetched. With a
+    `checkpoint`, pages are kept as they arrive and pages kept by an
+    earlier attempt are yielded again instead of being fetched.
+    """
+    page_size = settings.JAWBONE_PAGE_SIZES[endpoint]
+    url = settings.JAWBONE_BASE_URL + JAWBONE_ENDPOINTS[endpoint]
+    params = {'limit': page_size}
+    if updated_after:
+        params['updated_after'] = updated_after
+    if start_time is not None:
+        params['start_time'] = start_time
+    if end_time is not None:
+        params['end_time'] = end_time
+    query = params
+    if checkpoint:
+        pages, next_link = checkpoint.resume(params)
+        if pages:
+            logger.debug('resuming {} after {} pages'.format(
+                checkpoint.prefix, len(pages)))
+            yield from pages
+            if not next_link:
+                return
+            url = settings.JAWBONE_BASE_URL + next_link
+            # Keep the page size if the next link doesn't carry it.
+            query = None if 'limit=' in url else {'limit': page_size}
+    while True:
+        apidata = get_jawbone_data(access_token=access_token, url=url,
+                                   params=query, endpoint=endpoint,
+                                   stats=stats, raise_errors=True)
+        data = apidata.get('data') or {}
+        if 'items' not in data:
+            raise JawboneFetchError(url, 200)
+        next_link = (data.get('links') or {}).get('next')
+        items = data['items']
+        if checkpoint:
+            items = checkpoint.save(params, items, next_link)
+        yield items
+        if not next_link:
+            return
+        url = settings.JAWBONE_BASE_URL + next_link
+        query = None if 'limit=' in url else {'limit': page_size}
+
+
+def iter_jawbone_windows(access_token, endpoint, stats=None, checkpoint=None):
+    """
+    Yield the pages of an endpoint's whole history, newest first.
+
+    Instead of following one chain of `next` links, the history is split
+    into windows of JAWBONE_FETCH_WINDOW_DAYS ending at the newest item, and
+    JAWBONE_FETCH_CONCURRENCY windows are fetched at a time. Requests still
+    share the Jawbone rate-limit realm. Once the windows in flight have all
+    come back empty, one request looks for an older item: the windows carry
+    on from it, or stop if there is none. They never reach back further than
+    JAWBONE_HISTORY_START. Items are deduplicated by `xid`.
+    """
+    if stats is None:
+        stats = Counter()
+    url = settings.JAWBONE_BASE_URL + JAWBONE_ENDPOINTS[endpoint]
+
+    def newest_item(end_time=None):
+        # The newest item created up to `end_time`, or None.
+        params = {'limit': 1}
+        if end_time is not None:
+            params['end_time'] = end_time
+        items = get_jawbone_data(
+            access_token=access_token, url=url, params=params,
+            endpoint=endpoint, stats=stats, raise_errors=True)['data']['items']
+        return items[0] if items else None
+
+    newest = newest_item()
+    if newest is None:
+        return
+    if not isinstance(newest.get('time_created'), int):
+        yield from iter_jawbone_pages(access_token, endpoint, stats=stats,
+                                      checkpoint=checkpoint)
+        return
+    span = settings.JAWBONE_FETCH_WINDOW_DAYS * 86400
+
+    def iter_windows(end):
+        while end > settings.JAWBONE_HISTORY_START:
+            start = max(end - span, settings.JAWBONE_HISTORY_START)
+            yield (start, end - 1)
+            end = start
+
+    windows = iter_windows(newest['time_created'] + 1)
+
+    def fetch_window(window):
+        # Each window counts into its own Counter; they're added up here.
+        window_stats = Counter()
+        pages = list(iter_jawbone_pages(
+            access_token, endpoint, stats=window_stats,
+            start_time=window[0], end_time=window[1], checkpoint=checkpoint))
+        return pages, window_stats
+
+    seen = set()
+    concurrency = settings.JAWBONE_FETCH_CONCURRENCY
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Only a few windows ahead of the one being yielded are held.
+        pending = deque()
+
+        def submit(count):
+            for window in itertools.islice(windows, count):
+                pending.append((window, executor.submit(fetch_window, window)))
+
+        submit(concurrency)
+        while pending:
+            window, future = pending.popleft()
+            pages, window_stats = future.result()
+            stats.update(window_stats)
+            if any(pages):
+                submit(1)
+            elif not pending and window[0] > settings.JAWBONE_HISTORY_START:
+                # Skip over the empty windows to the next older item.
+                older = newest_item(end_time=window[0] - 1)
+                if older is not None:
+                    windows = iter_windows(older['time_created'] + 1)
+                    submit(concurrency)
+            for items in pages:
+                items = [item for item in items
+                         if item.get('xid') is None or
+                         item['xid'] not in seen]
+                seen.update(item.get('xid') for item in items)
+                if items:
+                    yield items
+
 
+def get_aggregate_jawbone_data(access_token, endpoint, updated_after=0):
+    agg_data = []
+    for items in fetch_jawbone_pages(access_token, endpoint, updated_after):
+        agg_data.extend(items)
     return agg_data
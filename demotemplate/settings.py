@@ -45,17 +45,116 @@ if OPENHUMANS_APP_BASE_URL[-1] == "/":
 OPENHUMANS_CLIENT_ID = os.getenv('OH_CLIENT_ID')
 OPENHUMANS_CLIENT_SECRET = os.getenv('OH_CLIENT_SECRET')
 OH_ACTIVITY_PAGE = os.getenv('OH_ACTIVITY_PAGE')
-OPENHUMANS_OH_BASE_URL = 'https://www.openhumans.org'
+OPENHUMANS_OH_BASE_URL = os.getenv('OH_BASE_URL',
+                                   'https://www.openhumans.org')
 
 OH_API_BASE = OPENHUMANS_OH_BASE_URL + '/api/direct-sharing'
 OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
 OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
 
+# Base URL of Jawbone's OAuth2 token and nudge API endpoints. Both can be
+# pointed at local stand-ins (see main/fakes.py).
+JAWBONE_BASE_URL = os.getenv('JAWBONE_BASE_URL', 'https://jawbone.com')
 JAWBONE_CLIENT_ID = os.getenv('JAWBONE_CLIENT_ID')
 JAWBONE_CLIENT_SECRET = os.getenv('JAWBONE_CLIENT_SECRET')
 JAWBONE_REDIRECT_URI = os.getenv('JAWBONE_REDIRECT_URI')
 
+# Celery queues. Syncs a member asked for go to the interactive queue, so
+# they don't wait behind the scheduled refreshes on the bulk queue.
+SYNC_INTERACTIVE_QUEUE = os.getenv('SYNC_INTERACTIVE_QUEUE', 'interactive')
+SYNC_BULK_QUEUE = os.getenv('SYNC_BULK_QUEUE', 'bulk')
+
+# A member can ask for a sync at most every SYNC_MIN_INTERVAL seconds. Only
+# one sync per member is queued or running at a time (a sync the member
+# asks for replaces a scheduled one that hasn't started); its lease expires
+# after SYNC_LEASE_TTL seconds in case a worker dies mid-sync.
+SYNC_MIN_INTERVAL = int(os.getenv('SYNC_MIN_INTERVAL', 3600))
+SYNC_LEASE_TTL = int(os.getenv('SYNC_LEASE_TTL', 6 * 3600))
+
+# Longest time (in seconds) a member's Open Humans file listing is cached
+# for the dashboard. Shorter if its download URLs expire sooner.
+JAWBONE_FILES_CACHE_TTL = int(os.getenv('JAWBONE_FILES_CACHE_TTL', 600))
+
+# Token refreshes of a member are serialized by a lock that expires after
+# TOKEN_REFRESH_LOCK_TIMEOUT seconds. Others wait for it at most
+# TOKEN_REFRESH_LOCK_WAIT seconds.
+TOKEN_REFRESH_LOCK_TIMEOUT = int(os.getenv('TOKEN_REFRESH_LOCK_TIMEOUT', 30))
+TOKEN_REFRESH_LOCK_WAIT = int(os.getenv('TOKEN_REFRESH_LOCK_WAIT', 15))
+
+# Seconds a process reuses an access token it read or refreshed before it
+# checks the database again.
+ACCESS_TOKEN_CACHE_TTL = int(os.getenv('ACCESS_TOKEN_CACHE_TTL', 60))
+
+# Number of Jawbone endpoints of a member that are synced at the same time.
+JAWBONE_ENDPOINT_CONCURRENCY = int(os.getenv('JAWBONE_ENDPOINT_CONCURRENCY',
+                                             3))
+
+# Items asked for per Jawbone page (the API's `limit`), by endpoint.
+# Larger pages use fewer requests of the rate-limit budget.
+# JAWBONE_PAGE_SIZE sets all endpoints, JAWBONE_<ENDPOINT>_PAGE_SIZE one.
+JAWBONE_PAGE_SIZE = int(os.getenv('JAWBONE_PAGE_SIZE', 100))
+JAWBONE_PAGE_SIZES = {
+    endpoint: int(os.getenv('JAWBONE_{}_PAGE_SIZE'.format(endpoint.upper()),
+                            JAWBONE_PAGE_SIZE))
+    for endpoint in ('heartrates', 'moves', 'sleeps')}
+
+# Full syncs can fetch a member's history as concurrent time windows of
+# JAWBONE_FETCH_WINDOW_DAYS, JAWBONE_FETCH_CONCURRENCY at a time, instead of
+# following `next` links one page after another. Windows stop at the
+# member's oldest item, and never reach back further than
+# JAWBONE_HISTORY_START (epoch seconds; UP launched in November 2011).
+JAWBONE_SHARDED_FETCH = True if os.getenv(
+    'JAWBONE_SHARDED_FETCH', '').lower() == 'true' else False
+JAWBONE_FETCH_WINDOW_DAYS = int(os.getenv('JAWBONE_FETCH_WINDOW_DAYS', 90))
+JAWBONE_FETCH_CONCURRENCY = int(os.getenv('JAWBONE_FETCH_CONCURRENCY', 4))
+JAWBONE_HISTORY_START = int(os.getenv('JAWBONE_HISTORY_START', 1320105600))
+
+# Longest a sync blocks waiting for the Jawbone rate limit (in seconds)
+# before it is rescheduled instead.
+JAWBONE_MAX_RATE_WAIT = int(os.getenv('JAWBONE_MAX_RATE_WAIT', 60))
+
+# Pages fetched by a full sync are kept in the cache for this many seconds
+# until the sync finishes, so a retry continues after the last good page
+# (0 turns this off). They take about as much Redis memory as the cleaned
+# data: roughly 5 MB for ten years of moves, well under 1 MB for sleeps or
+# heartrates. Incremental syncs aren't kept. Syncs answered 429 or 5xx by
+# Jawbone are retried after JAWBONE_FETCH_RETRY_DELAY seconds.
+JAWBONE_PAGE_CHECKPOINT_TTL = int(os.getenv('JAWBONE_PAGE_CHECKPOINT_TTL',
+                                            6 * 3600))
+JAWBONE_FETCH_RETRY_DELAY = int(os.getenv('JAWBONE_FETCH_RETRY_DELAY', 60))
+
+# Files are built in memory before they're uploaded to Open Humans, and
+# spill over to a temporary file (removed once uploaded) above this many
+# bytes.
+UPLOAD_SPOOL_SIZE = int(os.getenv('UPLOAD_SPOOL_SIZE', 16 * 1024 * 1024))
+
+# Also upload flattened time-series fields of each endpoint as NumPy arrays
+# (jawbone-{endpoint}-data.npz) for analysts. Requires numpy.
+JAWBONE_COLUMNAR_EXPORT = True if os.getenv(
+    'JAWBONE_COLUMNAR_EXPORT', '').lower() == 'true' else False
+
+# Split the data of each endpoint into monthly files plus a manifest
+# (jawbone-{endpoint}-YYYY-MM.json, jawbone-{endpoint}-manifest.json), so a
+# sync only re-uploads the months that changed.
+JAWBONE_PARTITIONED_FILES = True if os.getenv(
+    'JAWBONE_PARTITIONED_FILES', '').lower() == 'true' else False
+
+# Sync metrics (see datauploader/metrics.py). With METRICS_PORT set, each
+# worker process serves them in the Prometheus text format at /metrics on
+# METRICS_PORT plus its pool index. With STATSD_HOST set, they are also
+# pushed to statsd.
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) or None
+STATSD_HOST = os.getenv('STATSD_HOST')
+STATSD_PORT = int(os.getenv('STATSD_PORT', 8125))
+STATSD_PREFIX = os.getenv('STATSD_PREFIX', 'jawbone')
+
+# Pooled keep-alive HTTP sessions (see main/http.py). Connection pools are
+# kept for up to HTTP_POOL_CONNECTIONS hosts per service, each holding up
+# to HTTP_POOL_MAXSIZE connections.
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 10))
+
 # Requests Respectful (rate limiting, waiting)
 if REMOTE is True:
     from urllib.parse import urlparse
@@ -70,8 +169,27 @@ if REMOTE is True:
         safety_threshold=5)
 
 # This creates a Realm called "source" that allows 60 requests per minute maximum.
+# All Jawbone API calls go through JAWBONE_RATE_LIMIT_REALM.
+JAWBONE_RATE_LIMIT_REALM = 'jawbone'
 rr = RespectfulRequester()
-rr.register_realm("jawbone", max_requests=60, timespan=60)
+rr.register_realm(JAWBONE_RATE_LIMIT_REALM, max_requests=60, timespan=60)
+
+# Cache, also used for the per-member sync leases, token refresh locks,
+# page checkpoints and the dashboard's file listings. Web and worker
+# processes must share these, so the cache is always in Redis: REDIS_URL,
+# or else database 1 of the Redis server the rate limiter uses.
+respectful_redis = RespectfulRequester.configure()['redis']
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL') or 'redis://{}:{}/1'.format(
+            respectful_redis['host'], respectful_redis['port']),
+        'KEY_PREFIX': 'jawbone',
+    }
+}
+if not os.getenv('REDIS_URL') and respectful_redis['password']:
+    CACHES['default']['OPTIONS'] = {
+        'PASSWORD': respectful_redis['password']}
 
 # Applications installed
 INSTALLED_APPS = [
@@ -0,0 +1,398 @@
+"""
+Local stand-ins for the Jawbone nudge API and the Open Humans
+direct-sharing API (including the S3 uploads it hands out), and synthetic
+member histories to serve from them.
+
+They are used by the tests and by `manage.py benchmark_sync`, and run in
+background threads of the calling process:
+
+    with fake_services() as (jawbone, open_humans):
+        jawbone.add_member('jawbone-token', synthetic_history(years=1))
+        ...
+"""
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlencode, urlparse
+import json
+import random
+import threading
+import time
+
+from django.test import override_settings
+from datauploader.metrics import ThreadingHTTPServer
+
+JAWBONE_API_PATH = '/nudge/api/v.1.1/users/@me'
+SYNTHETIC_END = date(2017, 6, 30)
+OH_API_PATH = '/api/direct-sharing'
+
+
+def fake_service_settings(jawbone, open_humans):
+    """
+    Return the settings that point this app at the given fake services,
+    for use with `override_settings`.
+    """
+    oh_api_base = open_humans.url + OH_API_PATH
+    return {
+        'JAWBONE_BASE_URL': jawbone.url,
+        'OPENHUMANS_OH_BASE_URL': open_humans.url,
+        'OH_API_BASE': oh_api_base,
+        'OH_DIRECT_UPLOAD': oh_api_base + '/project/files/upload/direct/',
+        'OH_DIRECT_UPLOAD_COMPLETE': (oh_api_base +
+                                      '/project/files/upload/complete/'),
+        'OH_DELETE_FILES': oh_api_base + '/project/files/delete/',
+    }
+
+
+@contextmanager
+def fake_services(jawbone_options=None, open_humans_options=None):
+    """
+    Run a FakeJawbone and a FakeOpenHumans, with settings pointing at them.
+    """
+    with FakeJawbone(**(jawbone_options or {})) as jawbone, \
+            FakeOpenHumans(**(open_humans_options or {})) as open_humans, \
+            override_settings(**fake_service_settings(jawbone, open_humans)):
+        yield jawbone, open_humans
+
+
+def synthetic_history(years, seed=0, end=SYNTHETIC_END):
+    """
+    Return {endpoint: items} for a member with `years` of daily moves,
+    sleeps and heartrates up to `end`, newest first like Jawbone returns
+    them. Items are shaped like Jawbone's, location fields included.
+    """
+    rng = random.Random(seed)
+    history = {'heartrates': [], 'moves': [], 'sleeps': []}
+    for n in range(int(round(365.25 * years))):
+        day = end - timedelta(days=n)
+        start = int(datetime.combine(
+            day, dt_time(), tzinfo=timezone.utc).timestamp())
+        place = {'place_lat': round(rng.uniform(-90, 90), 6),
+                 'place_lon': round(rng.uniform(-180, 180), 6),
+                 'place_acc': rng.randint(5, 100),
+                 'place_name': 'Home'}
+        ymd = int(day.strftime('%Y%m%d'))
+        steps = rng.randint(1000, 25000)
+        hourly_totals = {}
+        for hour in range(24):
+            hour_steps = steps // 24 if 7 <= hour <= 22 else 0
+            hourly_totals['{}{:02d}'.format(ymd, hour)] = {
+                'steps': hour_steps,
+                'distance': hour_steps * 0.75,
+                'calories': round(hour_steps * 0.04, 3),
+                'active_time': hour_steps // 2,
+            }
+        history['moves'].append(dict(place, **{
+            'xid': 'move-{}-{}'.format(seed, ymd),
+            'title': '{:,} steps'.format(steps),
+            'type': 'move',
+            'time_created': start,
+            'time_updated': start + 86400,
+            'time_completed': start + 86399,
+            'date': ymd,
+            'snapshot_image': '/nudge/image/e/{}.png'.format(start),
+            'details': {
+                'steps': steps,
+                'distance': steps * 0.75,
+                'km': round(steps * 0.00075, 3),
+                'calories': round(steps * 0.04, 3),
+                'bmr_day': 1800.0,
+                'active_time': steps // 2,
+                'inactive_time': 86400 - steps // 2,
+                'tz': 'America/Los_Angeles',
+                'hourly_totals': hourly_totals,
+            },
+        }))
+        duration = rng.randint(4 * 3600, 10 * 3600)
+        light = int(duration * rng.uniform(0.4, 0.6))
+        awake = rng.randint(0, 1800)
+        history['sleeps'].append(dict(place, **{
+            'xid': 'sleep-{}-{}'.format(seed, ymd),
+            'title': 'for {}h {}m'.format(
+                duration // 3600, duration % 3600 // 60),
+            'sub_type': 0,
+            'time_created': start - duration,
+            'time_updated': start + 3600,
+            'time_completed': start,
+            'date': ymd,
+            'details': {
+                'duration': duration,
+                'light': light,
+                'sound': duration - light - awake,
+                'awake': awake,
+                'awakenings': rng.randint(0, 5),
+                'quality': rng.randint(40, 100),
+                'asleep_time': start - duration + 900,
+                'awake_time': start,
+                'tz': 'America/Los_Angeles',
+            },
+        }))
+        history['heartrates'].append(dict(place, **{
+            'xid': 'heartrate-{}-{}'.format(seed, ymd),
+            'title': '',
+            'time_created': start + 7 * 3600,
+            'time_updated': start + 7 * 3600,
+            'date': ymd,
+            'resting_heartrate': rng.randint(50, 80),
+            'details': {'tz': 'America/Los_Angeles'},
+        }))
+    return history
+
+
+class FakeService(object):
+    """
+    An HTTP server answering with `handler_class` from a daemon thread.
+    Requests are counted in `calls`, keyed by what the handler names them.
+    """
+    handler_class = None
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        handler = type('Handler', (self.handler_class,), {'service': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def count(self, call, n=1):
+        with self.lock:
+            self.calls[call] += n
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the
+    # body back until the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urlparse(self.path)
+        self.route = url.path
+        self.query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if self.service.latency:
+            time.sleep(self.service.latency)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def read_form(self):
+        return {k: v[0] for k, v in
+                parse_qs(self.read_body().decode('utf-8')).items()}
+
+    def respond(self, status, data=None, body=None):
+        if body is None:
+            body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeJawboneHandler(FakeHandler):
+
+    def do_GET(self):
+        self.parse()
+        service = self.service
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        history = service.members.get(token)
+        if history is None:
+            service.count('unauthorized')
+            return self.respond(401, {'meta': {'code': 401}})
+        if service.throttled():
+            service.count('throttled')
+            return self.respond(429, {'meta': {'code': 429}})
+        if self.route == JAWBONE_API_PATH:
+            service.count('user')
+            return self.respond(200, {'meta': {'code': 200},
+                                      'data': {'xid': 'xid-' + token}})
+        endpoint = self.route[len(JAWBONE_API_PATH) + 1:]
+        if not self.route.startswith(JAWBONE_API_PATH + '/') or \
+                endpoint not in history:
+            service.count('not_found')
+            return self.respond(404, {'meta': {'code': 404}})
+        service.count('page')
+        items = history[endpoint]
+        updated_after = int(self.query.get('updated_after', 0))
+        start_time = int(self.query.get('start_time', 0))
+        end_time = int(self.query.get('end_time', 2 ** 62))
+        items = [item for item in items
+                 if item['time_updated'] > updated_after and
+                 start_time <= item['time_created'] <= end_time]
+        limit = min(int(self.query.get('limit', service.page_size)),
+                    service.max_page_size)
+        offset = int(self.query.get('page_token', 0))
+        page = items[offset:offset + limit]
+        links = {}
+        if offset + limit < len(items):
+            query = dict(self.query, page_token=offset + limit)
+            links['next'] = '{}?{}'.format(self.route, urlencode(query))
+        service.count('items', len(page))
+        self.respond(200, {'meta': {'code': 200},
+                           'data': {'items': page, 'size': len(page),
+                                    'links': links}})
+
+    def do_POST(self):
+        self.parse()
+        self.read_body()
+        self.service.count('token')
+        self.respond(200, {'access_token': 'new_jawbone_access_token',
+                           'refresh_token': 'new_jawbone_refresh_token',
+                           'expires_in': 31536000})
+
+
+class FakeJawbone(FakeService):
+    """
+    The Jawbone nudge API: pages of `page_size` items (or `limit`, up to
+    `max_page_size`) with relative `next` links, filtered by
+    `updated_after` and `start_time`/`end_time`. Each request waits
+    `latency` seconds and is answered 429 with probability `throttle_rate`.
+    """
+    handler_class = FakeJawboneHandler
+
+    def __init__(self, latency=0, throttle_rate=0, page_size=10,
+                 max_page_size=100, seed=0):
+        super(FakeJawbone, self).__init__(latency=latency)
+        self.members = {}
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.random = random.Random(seed)
+
+    def add_member(self, access_token, history):
+        self.members[access_token] = history
+
+    def throttled(self):
+        if not self.throttle_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+
+class FakeOpenHumansHandler(FakeHandler):
+
+    def do_GET(self):
+        self.parse()
+        service = self.service
+        if self.route.startswith('/s3/'):
+            service.count('download')
+            body = service.uploads.get(self.route[len('/s3/'):])
+            if body is None:
+                return self.respond(404, {})
+            return self.respond(200, body=body)
+        if self.route == OH_API_PATH + '/project/exchange-member/':
+            service.count('exchange_member')
+            token = self.query.get('access_token')
+            files = [dict(f, download_url='{}/s3/{}'.format(
+                            service.url, f['id']))
+                     for f in service.files.get(token, {}).values()]
+            return self.respond(200, {'project_member_id': token,
+                                      'data': files, 'next': None})
+        self.respond(404, {})
+
+    def do_PUT(self):
+        self.parse()
+        self.service.count('s3_put')
+        body = self.read_body()
+        with self.service.lock:
+            self.service.uploads[self.route[len('/s3/'):]] = body
+            self.service.bytes_uploaded += len(body)
+        self.respond(200, {})
+
+    def do_POST(self):
+        self.parse()
+        service = self.service
+        form = self.read_form()
+        token = self.query.get('access_token')
+        if self.route == '/oauth2/token/':
+            service.count('token')
+            return self.respond(200, {
+                'access_token': 'new_oh_access_token',
+                'refresh_token': 'new_oh_refresh_token',
+                'expires_in': 36000})
+        member_files = service.files.setdefault(token, {})
+        if self.route == OH_API_PATH + '/project/files/delete/':
+            service.count('delete')
+            with service.lock:
+                for file_id, f in list(member_files.items()):
+                    if f['basename'] == form.get('file_basename'):
+                        del member_files[file_id]
+            return self.respond(200, {})
+        if self.route == OH_API_PATH + '/project/files/upload/direct/':
+            service.count('upload')
+            with service.lock:
+                service.next_id += 1
+                file_id = str(service.next_id)
+            service.pending[file_id] = (token, {
+                'id': file_id,
+                'basename': form['filename'],
+                'metadata': json.loads(form['metadata']),
+            })
+            return self.respond(201, {
+                'id': file_id, 'url': '{}/s3/{}'.format(service.url,
+                                                        file_id)})
+        if self.route == OH_API_PATH + '/project/files/upload/complete/':
+            service.count('upload_complete')
+            token, f = service.pending.pop(form['file_id'])
+            with service.lock:
+                service.files.setdefault(token, {})[f['id']] = f
+            return self.respond(200, {})
+        self.respond(404, {})
+
+
+class FakeOpenHumans(FakeService):
+    """
+    The Open Humans OAuth2 token and direct-sharing endpoints used here,
+    with direct uploads PUT to and downloaded from a fake S3 under /s3/.
+    Files are kept per access token.
+    """
+    handler_class = FakeOpenHumansHandler
+
+    def __init__(self, latency=0):
+        super(FakeOpenHumans, self).__init__(latency=latency)
+        self.files = {}
+        self.pending = {}
+        self.uploads = {}
+        self.next_id = 0
+        self.bytes_uploaded = 0
+
+    def member_files(self, access_token):
+        """
+        Return the contents of a member's files by basename.
+        """
+        return {f['basename']: self.uploads[f['id']]
+                for f in self.files.get(access_token, {}).values()}
@@ -1,27 +1,81 @@
-from ohapi import api
+from open_humans.direct_sharing import exchange_member
 from django.conf import settings
+from django.core.cache import cache
+from urllib.parse import urlparse, parse_qs
 import arrow
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
 
 
-def get_jawbone_files(oh_member):
+def jawbone_files_cache_key(oh_id):
+    return 'jawbone-files:{}'.format(oh_id)
+
+
+def get_jawbone_files(oh_member, oh_access_token=None):
+    """
+    Return the member's Jawbone files on Open Humans, or 'error'.
+    The listing is cached until JAWBONE_FILES_CACHE_TTL passes or one of
+    its download URLs is about to expire, whichever comes first.
+    Without `oh_access_token` the member's token is refreshed if needed,
+    which uses the database.
+    """
+    cache_key = jawbone_files_cache_key(oh_member.oh_id)
+    files = cache.get(cache_key)
+    if files is not None:
+        return files
     try:
         files = []
-        oh_access_token = oh_member.get_access_token(
-                                client_id=settings.OPENHUMANS_CLIENT_ID,
-                                client_secret=settings.OPENHUMANS_CLIENT_SECRET)
-        user_object = api.exchange_oauth2_member(oh_access_token)
+        if oh_access_token is None:
+            oh_access_token = oh_member.get_access_token(
+                client_id=settings.OPENHUMANS_CLIENT_ID,
+                client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+        user_object = exchange_member(oh_access_token)
         for dfile in user_object['data']:
             if 'Jawbone' in dfile['metadata']['tags']:
                 files.append({'url': dfile['download_url'],
                               'name': dfile['basename']})
-        return files
-
     except:
         return 'error'
+    timeout = settings.JAWBONE_FILES_CACHE_TTL
+    for dfile in files:
+        expires = get_url_expiry(dfile['url'])
+        if expires is not None:
+            # Leave members time to click the link before it expires.
+            timeout = min(timeout, int(expires - time.time()) - 60)
+    if timeout > 0:
+        cache.set(cache_key, files, timeout)
+    return files
+
+
+def invalidate_jawbone_files(oh_id):
+    cache.delete(jawbone_files_cache_key(oh_id))
+
+
+def get_url_expiry(url):
+    """
+    Return when a pre-signed S3 download URL expires (epoch seconds), or
+    None if it doesn't say.
+    """
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'Expires' in query:
+            return int(query['Expires'][0])
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            signed = datetime.strptime(query['X-Amz-Date'][0],
+                                       '%Y%m%dT%H%M%SZ')
+            signed = signed.replace(tzinfo=timezone.utc).timestamp()
+            return signed + int(query['X-Amz-Expires'][0])
+    except ValueError:
+        pass
+    return None
 
 
 def check_update(jawbone_member):
-    if jawbone_member.last_submitted < (arrow.now() - timedelta(hours=1)):
+    """
+    Return whether the member may ask for a new sync. Syncs a member asks
+    for are at least SYNC_MIN_INTERVAL seconds apart.
+    """
+    min_interval = timedelta(seconds=settings.SYNC_MIN_INTERVAL)
+    if jawbone_member.last_submitted < (arrow.now() - min_interval):
         return True
     return False
@@ -0,0 +1,45 @@
+"""
+Shared HTTP sessions for talking to Jawbone and Open Humans.
+
+Every process keeps one `requests.Session` per service, so consecutive
+calls to the same host reuse pooled keep-alive connections instead of
+opening a new TCP and TLS connection each time.
+"""
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(service):
+    """
+    Return this process's pooled session for `service`.
+    """
+    # Keyed by pid so that forked Celery workers don't share sockets.
+    key = (os.getpid(), service)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+    return session
+
+
+def jawbone_session():
+    return get_session('jawbone')
+
+
+def openhumans_session():
+    return get_session('openhumans')
@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import resource
+import time
+import uuid
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import override_settings
+from datauploader.tasks import process_jawbone, rr
+from main.fakes import SYNTHETIC_END, fake_services, synthetic_history
+from main.models import DataSourceMember
+from open_humans.models import OpenHumansMember
+import arrow
+
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark-sync',
+    }
+}
+
+
+class Command(BaseCommand):
+    help = ('Measures process_jawbone against local Jawbone and Open Humans '
+            'stand-ins, in a throwaway test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=2,
+                            help='Members per history length')
+        parser.add_argument('--years', type=float, nargs='+',
+                            default=[1, 5, 10],
+                            help='History lengths to generate, in years')
+        parser.add_argument('--passes', type=int, default=2,
+                            help='Syncs of every member; the first one is '
+                                 'a full sync, later ones are incremental')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Members synced at the same time')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds each fake API request takes')
+        parser.add_argument('--throttle-rate', type=float, default=0,
+                            help='Share of Jawbone requests answered 429')
+        parser.add_argument('--page-size', type=int,
+                            help='Items per Jawbone page, instead of '
+                                 'JAWBONE_PAGE_SIZES')
+        parser.add_argument('--sharded', action='store_true',
+                            help='Fetch full histories as concurrent time '
+                                 'windows (JAWBONE_SHARDED_FETCH)')
+        parser.add_argument('--rate-limit', type=int, default=100000,
+                            help='Jawbone requests per minute allowed by '
+                                 'the rate limiter during the run')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        # Leases, locks and page checkpoints go to a cache of this process,
+        # and requests to a realm of their own, so running the benchmark
+        # where Redis serves workers leaves their state and limits alone.
+        realm = 'benchmark-jawbone-{}'.format(uuid.uuid4().hex)
+        rr.register_realm(realm, max_requests=options['rate_limit'],
+                          timespan=60)
+        page_sizes = settings.JAWBONE_PAGE_SIZES
+        if options['page_size']:
+            page_sizes = {endpoint: options['page_size']
+                          for endpoint in page_sizes}
+        # Sharded fetches reach back to the start of the synthetic history.
+        history_start = datetime.combine(
+            SYNTHETIC_END - timedelta(days=365.25 * max(options['years'])),
+            datetime.min.time(), tzinfo=timezone.utc).timestamp()
+        try:
+            jawbone_options = {'latency': options['latency'],
+                               'throttle_rate': options['throttle_rate']}
+            open_humans_options = {'latency': options['latency']}
+            with override_settings(
+                    CACHES=BENCHMARK_CACHES,
+                    JAWBONE_RATE_LIMIT_REALM=realm,
+                    JAWBONE_PAGE_SIZES=page_sizes,
+                    JAWBONE_SHARDED_FETCH=options['sharded'],
+                    JAWBONE_HISTORY_START=int(history_start)), \
+                    fake_services(jawbone_options,
+                                  open_humans_options) as services:
+                oh_ids = self.create_members(services[0], options)
+                for n in range(options['passes']):
+                    self.run_pass(n + 1, oh_ids, services, options)
+        finally:
+            rr.unregister_realm(realm)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def create_members(self, jawbone, options):
+        oh_ids = []
+        for years in options['years']:
+            for n in range(options['members']):
+                seed = len(oh_ids)
+                oh_id = str(10000000 + seed)
+                jawbone_token = 'jawbone-{}'.format(oh_id)
+                jawbone.add_member(jawbone_token,
+                                   synthetic_history(years, seed=seed))
+                oh_member = OpenHumansMember.create(
+                    oh_id=oh_id, access_token='oh-{}'.format(oh_id),
+                    refresh_token='oh-refresh-{}'.format(oh_id),
+                    expires_in=36000)
+                oh_member.save()
+                jawbone_member = DataSourceMember(
+                    jawbone_id='xid-{}'.format(jawbone_token),
+                    access_token=jawbone_token,
+                    refresh_token='jawbone-refresh-{}'.format(oh_id),
+                    token_expires=DataSourceMember.get_expiration(36000),
+                    last_updated=arrow.get('2016-06-19').format(),
+                    last_submitted=arrow.get('2016-06-19').format())
+                jawbone_member.user = oh_member
+                jawbone_member.save()
+                oh_ids.append(oh_id)
+        self.stdout.write('{} members, {} with each of {} years of '
+                          'history'.format(len(oh_ids), options['members'],
+                                           options['years']))
+        return oh_ids
+
+    def run_pass(self, number, oh_ids, services, options):
+        jawbone, open_humans = services
+        jawbone_calls = jawbone.calls.copy()
+        open_humans_calls = open_humans.calls.copy()
+        bytes_uploaded = open_humans.bytes_uploaded
+        start = time.time()
+        with ThreadPoolExecutor(
+                max_workers=options['concurrency']) as executor:
+            results = list(executor.map(self.sync, oh_ids))
+        seconds = time.time() - start
+        jawbone_calls = jawbone.calls - jawbone_calls
+        open_humans_calls = open_humans.calls - open_humans_calls
+        api_calls = (sum(jawbone_calls.values()) - jawbone_calls['items'] +
+                     sum(open_humans_calls.values()))
+        # ru_maxrss is in kilobytes on Linux.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stdout.write(
+            'pass {}: {:.1f}s, {:.1f} members/min, {:.1f} pages/sec, '
+            '{:.0f} items/sec, {:.1f} API calls/member, {} throttled, '
+            '{:.1f} MB uploaded, {} failed, peak RSS {:.0f} MB'.format(
+                number, seconds, len(oh_ids) / seconds * 60,
+                jawbone_calls['page'] / seconds,
+                jawbone_calls['items'] / seconds,
+                api_calls / len(oh_ids), jawbone_calls['throttled'],
+                (open_humans.bytes_uploaded - bytes_uploaded) / 1e6,
+                results.count(False), peak_rss / 1024))
+
+    def sync(self, oh_id):
+        try:
+            result = process_jawbone.apply(args=[oh_id])
+            if result.failed():
+                self.stderr.write('sync of {} failed: {!r}'.format(
+                    oh_id, result.result))
+                return False
+            return True
+        finally:
+            connections.close_all()
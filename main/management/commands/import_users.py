@@ -1,12 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
 from django.core.management.base import BaseCommand
-from open_humans.models import OpenHumansMember
+from django.contrib.auth.models import User
+from django.db import transaction
+from open_humans.models import OpenHumansMember, make_unique_username
 from main.models import DataSourceMember
 from django.conf import settings
-from datauploader.tasks import process_jawbone
-
-import requests
+from datauploader.tasks import queue_jawbone_sync
+from main.http import jawbone_session
 # import vcr
 
+# Largest number of ids in one `IN (...)` query, within sqlite's limit.
+QUERY_CHUNK = 500
+
+# Longest countdown of a queued sync (in seconds). Redis redelivers tasks
+# whose ETA is further away than its visibility timeout (an hour by
+# default), so the import waits instead of scheduling further ahead.
+MAX_COUNTDOWN = 30 * 60
+
 
 class Command(BaseCommand):
     help = 'Import existing users from legacy project'
@@ -16,10 +28,29 @@ class Command(BaseCommand):
                             help='CSV with project_member_id & refresh_token')
         parser.add_argument('--delimiter', type=str,
                             help='CSV delimiter')
+        parser.add_argument('--bulk', action='store_true',
+                            help='Verify users concurrently, insert them in '
+                                 'batches and record progress so an '
+                                 'interrupted import can be resumed')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Users verified at the same time (bulk)')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Users inserted per transaction (bulk)')
+        parser.add_argument('--checkpoint', type=str,
+                            help='File listing the oh_ids already handled '
+                                 '(bulk; default: the infile name plus '
+                                 '".checkpoint")')
+        parser.add_argument('--spread', type=float, default=3,
+                            help='Seconds between the syncs queued for '
+                                 'imported users (bulk). The import waits '
+                                 'rather than schedule syncs more than '
+                                 'MAX_COUNTDOWN seconds ahead')
 
     # @vcr.use_cassette('import_users.yaml', decode_compressed_response=True)
     #                  record_mode='none')
     def handle(self, *args, **options):
+        if options['bulk']:
+            return self.bulk_import(options)
         for line in open(options['infile']):
             line = line.strip().split(options['delimiter'])
             oh_id = line[0]
@@ -31,8 +62,9 @@ class Command(BaseCommand):
                 print(line)
                 jawbone_headers = {'Authorization': 'Bearer {}'.format(
                     jawbone_access_token)}
-                req = requests.get(
-                    'https://jawbone.com/nudge/api/v.1.1/users/@me',
+                req = jawbone_session().get(
+                    '{}/nudge/api/v.1.1/users/@me'.format(
+                        settings.JAWBONE_BASE_URL),
                     headers=jawbone_headers)
                 user_data = req.json()
                 if 'xid' not in user_data['data']:
@@ -55,5 +87,154 @@ class Command(BaseCommand):
                 )
                 jawbone_member.user = oh_member
                 jawbone_member.save()
-                process_jawbone.delay(oh_member.oh_id)
-                # process_jawbone(oh_member.oh_id)
+                queue_jawbone_sync(oh_member.oh_id)
+
+    def bulk_import(self, options):
+        """
+        Import the infile in batches. The oh_id of every line handled is
+        appended to the checkpoint file once its batch is committed and its
+        syncs are queued, and lines listed there are skipped when the
+        import is run again.
+        """
+        checkpoint = options['checkpoint'] or (
+            options['infile'] + '.checkpoint')
+        resuming = os.path.exists(checkpoint)
+        done = set()
+        if resuming:
+            with open(checkpoint) as f:
+                done = set(line.strip() for line in f)
+        rows = {}
+        for line in open(options['infile']):
+            line = line.strip().split(options['delimiter'])
+            if len(line) >= 4 and line[0] not in done:
+                rows.setdefault(line[0], line)
+        oh_ids = list(rows)
+        existing = set()
+        for start in range(0, len(oh_ids), QUERY_CHUNK):
+            existing.update(OpenHumansMember.objects.filter(
+                oh_id__in=oh_ids[start:start + QUERY_CHUNK]).values_list(
+                    'oh_id', flat=True))
+        rows = [row for oh_id, row in rows.items() if oh_id not in existing]
+        batch_size = options['batch_size']
+        imported = 0
+        self.sync_schedule = (time.time(), options['spread'])
+        self.queued = 0
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as \
+                executor, open(checkpoint, 'a') as checkpoint_file:
+            if resuming:
+                # Members committed by an interrupted run may not have had
+                # their syncs queued yet.
+                for oh_id in existing:
+                    self.queue_sync(oh_id)
+            checkpoint_file.writelines(
+                '{}\n'.format(oh_id) for oh_id in existing)
+            checkpoint_file.flush()
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                verified = [user for user in executor.map(self.verify, batch)
+                            if user]
+                with transaction.atomic():
+                    members = self.create_members(verified)
+                imported += len(members)
+                # Refresh tokens only once the members are committed, so
+                # the new tokens are saved as they come in, as
+                # _refresh_tokens does.
+                for oh_member, tokens in zip(members, executor.map(
+                        self.request_tokens, members)):
+                    if tokens is None:
+                        self.stderr.write(
+                            'Open Humans refused to refresh the tokens of '
+                            '{}'.format(oh_member.oh_id))
+                    else:
+                        oh_member.access_token = tokens['access_token']
+                        oh_member.refresh_token = tokens['refresh_token']
+                        oh_member.token_expires = \
+                            oh_member.get_expiration(tokens['expires_in'])
+                        oh_member.save(update_fields=[
+                            'access_token', 'refresh_token', 'token_expires'])
+                    self.queue_sync(oh_member.oh_id)
+                checkpoint_file.writelines(
+                    '{}\n'.format(row[0]) for row in batch)
+                checkpoint_file.flush()
+                self.stdout.write('{} of {} lines handled, {} users '
+                                  'imported'.format(start + len(batch),
+                                                    len(rows), imported))
+
+    def queue_sync(self, oh_id):
+        """
+        Queue a member's sync `spread` seconds after the previous one. ETAs
+        are kept within MAX_COUNTDOWN by waiting before queueing further.
+        """
+        started, spread = self.sync_schedule
+        countdown = started + self.queued * spread - time.time()
+        if countdown > MAX_COUNTDOWN:
+            time.sleep(countdown - MAX_COUNTDOWN)
+            countdown = MAX_COUNTDOWN
+        queue_jawbone_sync(oh_id, countdown=max(countdown, 0))
+        self.queued += 1
+
+    def verify(self, row):
+        """
+        Look up a line's Jawbone user. Runs in a worker thread, so it
+        doesn't touch the database.
+        """
+        oh_id, oh_access_token, oh_refresh_token, jawbone_access_token = \
+            row[:4]
+        req = jawbone_session().get(
+            '{}/nudge/api/v.1.1/users/@me'.format(settings.JAWBONE_BASE_URL),
+            headers={'Authorization': 'Bearer {}'.format(
+                jawbone_access_token)})
+        try:
+            xid = req.json().get('data', {}).get('xid')
+        except ValueError:
+            xid = None
+        if not xid:
+            self.stderr.write('skipping {}: no Jawbone user'.format(oh_id))
+            return None
+        return {'oh_id': oh_id, 'oh_access_token': oh_access_token,
+                'oh_refresh_token': oh_refresh_token, 'jawbone_id': xid,
+                'jawbone_access_token': jawbone_access_token}
+
+    def request_tokens(self, oh_member):
+        # Runs in a worker thread; the caller saves the tokens.
+        return OpenHumansMember.request_tokens(
+            oh_member.refresh_token, client_id=settings.OPENHUMANS_CLIENT_ID,
+            client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+
+    def create_members(self, users):
+        """
+        Insert the users, their Open Humans members and Jawbone members
+        with one query per table. Return the Open Humans members.
+        """
+        usernames = {user['oh_id']: '{}_openhumans'.format(user['oh_id'])
+                     for user in users}
+        taken = set(User.objects.filter(
+            username__in=usernames.values()).values_list(
+                'username', flat=True))
+        for oh_id, username in usernames.items():
+            if username in taken:
+                usernames[oh_id] = make_unique_username(username)
+        User.objects.bulk_create(
+            [User(username=username) for username in usernames.values()])
+        # sqlite doesn't return the ids of bulk created rows.
+        user_ids = dict(User.objects.filter(
+            username__in=usernames.values()).values_list('username', 'id'))
+        # Stored as expired until the tokens are refreshed, like the
+        # line-by-line import does.
+        members = OpenHumansMember.objects.bulk_create([
+            OpenHumansMember(
+                user_id=user_ids[usernames[user['oh_id']]],
+                oh_id=user['oh_id'],
+                access_token=user['oh_access_token'],
+                refresh_token=user['oh_refresh_token'],
+                token_expires=OpenHumansMember.get_expiration(-3600))
+            for user in users])
+        DataSourceMember.objects.bulk_create([
+            DataSourceMember(
+                user_id=user['oh_id'],
+                jawbone_id=user['jawbone_id'],
+                access_token=user['jawbone_access_token'],
+                refresh_token='unknown',
+                token_expires=DataSourceMember.get_expiration(1000000000))
+            for user in users])
+        return members
@@ -1,6 +1,8 @@
+from celery import group
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from main.models import DataSourceMember
-from datauploader.tasks import process_jawbone
+from datauploader.tasks import process_jawbone, acquire_sync_lease
 import arrow
 from datetime import timedelta
 
@@ -8,11 +10,40 @@ from datetime import timedelta
 class Command(BaseCommand):
     help = 'Updates data for all members'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of update tasks published at once')
+
     def handle(self, *args, **options):
-        users = DataSourceMember.objects.all()
-        for jawbone_user in users:
-            if jawbone_user.last_submitted < (arrow.now() - timedelta(days=4)):
-                oh_id = jawbone_user.user.oh_id
-                process_jawbone.delay(oh_id)
-            else:
-                print("didn't update {}".format(jawbone_user.moves_id))
+        # user_id is the OpenHumansMember primary key, i.e. the oh_id.
+        stale_members = DataSourceMember.objects.filter(
+            last_submitted__lt=(arrow.now() - timedelta(days=4)).datetime
+        ).order_by('pk').values_list('jawbone_id', 'user_id')
+        batch = []
+        submitted = 0
+        for member in stale_members.iterator(
+                chunk_size=options['batch_size']):
+            batch.append(member)
+            if len(batch) == options['batch_size']:
+                submitted += self.submit(batch)
+                batch = []
+        if batch:
+            submitted += self.submit(batch)
+        self.stdout.write('queued updates for {} members'.format(submitted))
+
+    @staticmethod
+    def submit(batch):
+        """
+        Publish one group of update tasks and mark the members submitted.
+        Members that already have a sync in flight are skipped.
+        """
+        batch = [(jawbone_id, oh_id) for jawbone_id, oh_id in batch
+                 if acquire_sync_lease(oh_id)]
+        if not batch:
+            return 0
+        group(process_jawbone.s(oh_id) for _, oh_id in batch).apply_async(
+            queue=settings.SYNC_BULK_QUEUE)
+        DataSourceMember.objects.filter(
+            pk__in=[jawbone_id for jawbone_id, _ in batch]
+        ).update(last_submitted=arrow.now().format())
+        return len(batch)
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EndpointSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=32)),
+                ('watermark', models.BigIntegerField(default=0)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='endpoint_syncs', to='main.DataSourceMember')),
+            ],
+            options={
+                'unique_together': {('member', 'endpoint')},
+            },
+        ),
+    ]
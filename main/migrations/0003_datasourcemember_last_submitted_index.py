@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_endpointsync'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datasourcemember',
+            name='last_submitted',
+            field=models.DateTimeField(db_index=True, default='2026-10-11 12:08:57+00:00'),
+        ),
+    ]
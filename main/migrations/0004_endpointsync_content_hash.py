@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_datasourcemember_last_submitted_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointsync',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_endpointsync_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endpointsync',
+            name='partitions',
+            field=models.TextField(blank=True, default='{}'),
+        ),
+    ]
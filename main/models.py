@@ -1,12 +1,13 @@
 from django.db import models
 from django.conf import settings
-from open_humans.models import OpenHumansMember
+from open_humans.models import OpenHumansMember, TokenRefreshMixin
 import requests
+from .http import jawbone_session
 from datetime import timedelta
 import arrow
 
 
-class DataSourceMember(models.Model):
+class DataSourceMember(TokenRefreshMixin, models.Model):
     """
     Store OAuth data for a data source.
     This is a one to one relationship with a OpenHumansMember model
@@ -28,7 +29,8 @@ class DataSourceMember(models.Model):
     last_updated = models.DateTimeField(
                             default=(arrow.now() - timedelta(days=7)).format())
     last_submitted = models.DateTimeField(
-                            default=(arrow.now() - timedelta(days=7)).format())
+                            default=(arrow.now() - timedelta(days=7)).format(),
+                            db_index=True)
 
     @staticmethod
     def get_expiration(expires_in):
@@ -40,19 +42,15 @@ class DataSourceMember(models.Model):
         """
         Return access token. Refresh first if necessary.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens(client_id=client_id,
-                                 client_secret=client_secret)
-        return self.access_token
+        return self.get_fresh_access_token(client_id=client_id,
+                                           client_secret=client_secret)
 
     def _refresh_tokens(self, client_id, client_secret):
         """
         Refresh access token.
         """
-        response = requests.post(
-            'https://jawbone.com/auth/oauth2/token?',
+        response = jawbone_session().post(
+            '{}/auth/oauth2/token?'.format(settings.JAWBONE_BASE_URL),
             data={
                 'grant_type': 'refresh_token',
                 'refresh_token': self.refresh_token,
@@ -65,3 +63,30 @@ class DataSourceMember(models.Model):
             self.refresh_token = data['refresh_token']
             self.token_expires = self.get_expiration(data['expires_in'])
             self.save()
+
+
+class EndpointSync(models.Model):
+    """
+    Store the sync state of one Jawbone endpoint for a DataSourceMember.
+
+    `watermark` is the largest `time_updated` (epoch seconds) of the items
+    already uploaded to Open Humans for this endpoint. The next sync only
+    asks Jawbone for items updated after it.
+
+    `content_hash` is the SHA-256 of the uploaded file, so unchanged data
+    isn't uploaded again.
+
+    `partitions` is used instead of `content_hash` when the data is split
+    into monthly files: a JSON object mapping each uploaded partition
+    ('YYYY-MM') to the SHA-256 of its file.
+    """
+    member = models.ForeignKey(DataSourceMember,
+                               related_name='endpoint_syncs',
+                               on_delete=models.CASCADE)
+    endpoint = models.CharField(max_length=32)
+    watermark = models.BigIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    partitions = models.TextField(blank=True, default='{}')
+
+    class Meta:
+        unique_together = ('member', 'endpoint')
@@ -1,10 +1,13 @@
-from datauploader.tasks import process_moves
-from django.test import TestCase
-from freezegun import freeze_time
+import json
+import threading
+from unittest import mock
+from datauploader.tasks import process_jawbone, FileListingError
+from django.test import TestCase, override_settings
 from django.conf import settings
-import vcr
-from open_humans.models import OpenHumansMember
-from main.models import DataSourceMember
+from django.core.cache import cache
+from open_humans.models import OpenHumansMember, access_token_cache
+from main.fakes import fake_services, synthetic_history
+from main.models import DataSourceMember, EndpointSync
 import arrow
 
 
@@ -16,31 +19,190 @@ class CeleryTestCase(TestCase):
     def setUp(self):
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
-        settings.MOVES_CLIENT_ID = 'moves_client_id'
-        settings.MOVES_CLIENT_SECRET = 'moves_client_secret'
+        settings.JAWBONE_CLIENT_ID = 'jawbone_client_id'
+        settings.JAWBONE_CLIENT_SECRET = 'jawbone_client_secret'
+        self.addCleanup(cache.clear)
+        self.addCleanup(access_token_cache.clear)
+        services = fake_services({'page_size': 100})
+        self.jawbone, self.open_humans = services.__enter__()
+        self.addCleanup(services.__exit__, None, None, None)
+        self.history = synthetic_history(years=0.1)
+        self.jawbone.add_member('new_jawbone_access_token', self.history)
         oh_member = OpenHumansMember.create(
                             oh_id=23456789,
                             access_token="new_oh_access_token",
                             refresh_token="new_oh_refresh_token",
                             expires_in=36000)
         oh_member.save()
-        moves_member = DataSourceMember(
-            moves_id=12345678,
-            access_token="new_moves_access_token",
-            refresh_token='new_moves_refresh_token',
+        jawbone_member = DataSourceMember(
+            jawbone_id='xid-new_jawbone_access_token',
+            access_token="new_jawbone_access_token",
+            refresh_token='new_jawbone_refresh_token',
             token_expires=DataSourceMember.get_expiration(
                 36000),
             last_updated=arrow.get('2016-06-19').format(),
             last_submitted=arrow.get('2016-06-19').format()
         )
-        moves_member.user = oh_member
-        moves_member.save()
+        jawbone_member.user = oh_member
+        jawbone_member.save()
 
-    @freeze_time('2016-06-24')
-    @vcr.use_cassette('main/tests/fixtures/import_users.yaml',
-                      record_mode='none')
     def test_update_command(self):
         oh_member = OpenHumansMember.objects.get(oh_id=23456789)
-        process_moves(oh_member.oh_id)
-        moves_member = DataSourceMember.objects.get(moves_id=12345678)
-        self.assertEqual(moves_member.last_updated, arrow.get('2016-06-24'))
+        process_jawbone(oh_member.oh_id)
+        jawbone_member = DataSourceMember.objects.get(
+            jawbone_id='xid-new_jawbone_access_token')
+        self.assertGreater(jawbone_member.last_updated,
+                           arrow.get('2016-06-19'))
+        files = self.open_humans.member_files('new_oh_access_token')
+        moves = json.loads(files['jawbone-moves-data.json'].decode('utf-8'))
+        self.assertEqual([item['xid'] for item in moves],
+                         [item['xid'] for item in self.history['moves']])
+        self.assertNotIn('place_lat', moves[0])
+
+        # Nothing changed since, so nothing is uploaded again.
+        calls = self.open_humans.calls.copy()
+        with mock.patch('main.models.EndpointSync.save') as save:
+            process_jawbone(oh_member.oh_id)
+        self.assertEqual(self.open_humans.calls, calls)
+        save.assert_not_called()
+
+        # New items are merged into the uploaded file.
+        item = dict(self.history['moves'][0], xid='new-move',
+                    time_updated=self.history['moves'][0]['time_updated'] + 1)
+        self.history['moves'].insert(0, item)
+        process_jawbone(oh_member.oh_id)
+        self.assertEqual(self.open_humans.calls['download'],
+                         calls['download'] + 1)
+        files = self.open_humans.member_files('new_oh_access_token')
+        moves = json.loads(files['jawbone-moves-data.json'].decode('utf-8'))
+        self.assertEqual([item['xid'] for item in moves],
+                         [item['xid'] for item in self.history['moves']])
+
+    def test_listing_error(self):
+        for partitioned in (False, True):
+            with override_settings(JAWBONE_PARTITIONED_FILES=partitioned):
+                process_jawbone('23456789')
+                self.history['moves'].insert(0, dict(
+                    self.history['moves'][0], xid='new-move-{}'.format(
+                        partitioned),
+                    time_updated=self.history['moves'][0][
+                        'time_updated'] + 1))
+                watermarks = dict(EndpointSync.objects.values_list(
+                    'endpoint', 'watermark'))
+                pages = self.jawbone.calls['page']
+                with mock.patch('main.helpers.exchange_member',
+                                side_effect=Exception('Open Humans is down')):
+                    with self.assertRaises(FileListingError):
+                        process_jawbone('23456789')
+                # No full sync in place of the failed merge.
+                self.assertLessEqual(self.jawbone.calls['page'],
+                                     pages + len(watermarks))
+                self.assertEqual(dict(EndpointSync.objects.values_list(
+                    'endpoint', 'watermark')), watermarks)
+
+    @override_settings(JAWBONE_PARTITIONED_FILES=True)
+    def test_partitioned_files(self):
+        process_jawbone('23456789')
+        files = self.open_humans.member_files('new_oh_access_token')
+        manifest = json.loads(
+            files['jawbone-moves-manifest.json'].decode('utf-8'))
+        moves = []
+        for partition in manifest['partitions']:
+            moves.extend(json.loads(files[partition['file']].decode('utf-8')))
+        self.assertEqual(sorted(item['xid'] for item in moves),
+                         sorted(item['xid'] for item in self.history['moves']))
+        sync = EndpointSync.objects.get(member__user__oh_id='23456789',
+                                        endpoint='moves')
+        self.assertEqual(sorted(json.loads(sync.partitions)),
+                         [p['partition'] for p in manifest['partitions']])
+
+        # Nothing changed since, so neither Open Humans is asked nor the
+        # sync state written again.
+        calls = self.open_humans.calls.copy()
+        with mock.patch('main.models.EndpointSync.save') as save:
+            process_jawbone('23456789')
+        save.assert_not_called()
+        self.assertEqual(self.open_humans.calls, calls)
+
+        # A monthly file has gone, so new data brings a full sync.
+        member_files = self.open_humans.files['new_oh_access_token']
+        for file_id, f in list(member_files.items()):
+            if f['basename'] == manifest['partitions'][0]['file']:
+                del member_files[file_id]
+        self.history['moves'].insert(0, dict(
+            self.history['moves'][0], xid='new-move',
+            time_updated=self.history['moves'][0]['time_updated'] + 1))
+        process_jawbone('23456789')
+        files = self.open_humans.member_files('new_oh_access_token')
+        moves = []
+        for partition in manifest['partitions']:
+            moves.extend(json.loads(files[partition['file']].decode('utf-8')))
+        self.assertEqual(sorted(item['xid'] for item in moves),
+                         sorted(item['xid'] for item in self.history['moves']))
+
+    @override_settings(JAWBONE_COLUMNAR_EXPORT=True)
+    def test_switch_to_single_file(self):
+        with override_settings(JAWBONE_PARTITIONED_FILES=True):
+            process_jawbone('23456789')
+        process_jawbone('23456789')
+        files = self.open_humans.member_files('new_oh_access_token')
+        self.assertEqual(sorted(files), sorted(
+            'jawbone-{}-data.{}'.format(endpoint, extension)
+            for endpoint in ('heartrates', 'moves', 'sleeps')
+            for extension in ('json', 'npz')))
+        moves = json.loads(files['jawbone-moves-data.json'].decode('utf-8'))
+        self.assertEqual([item['xid'] for item in moves],
+                         [item['xid'] for item in self.history['moves']])
+        self.assertEqual(set(EndpointSync.objects.values_list(
+            'partitions', flat=True)), {'{}'})
+
+    @override_settings(JAWBONE_COLUMNAR_EXPORT=True,
+                       JAWBONE_PARTITIONED_FILES=True)
+    def test_remove_jawbone(self):
+        process_jawbone('23456789')
+        files = self.open_humans.member_files('new_oh_access_token')
+        self.assertIn('jawbone-moves-2017-06.npz', files)
+        self.assertIn('jawbone-moves-manifest.json', files)
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        self.client.force_login(oh_member.user)
+        self.client.post('/remove_jawbone/')
+        self.assertEqual(self.open_humans.member_files('new_oh_access_token'),
+                         {})
+        self.assertFalse(DataSourceMember.objects.exists())
+
+    def test_workers_leave_database_alone(self):
+        process_jawbone('23456789')
+        self.history['moves'].insert(0, dict(
+            self.history['moves'][0], xid='new-move',
+            time_updated=self.history['moves'][0]['time_updated'] + 1))
+        # Merging the new item needs the file listing, from a worker.
+        threads = set()
+        get_access_token = OpenHumansMember.get_access_token
+
+        def record_thread(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return get_access_token(*args, **kwargs)
+
+        with mock.patch.object(OpenHumansMember, 'get_access_token',
+                               autospec=True, side_effect=record_thread):
+            process_jawbone('23456789')
+        self.assertEqual(threads, {threading.current_thread()})
+        self.assertEqual(self.open_humans.calls['download'], 1)
+
+    def test_keeps_concurrent_updates(self):
+        # update_data marks members submitted while their syncs run.
+        submitted = arrow.get('2017-01-01').datetime
+        get_or_create = EndpointSync.objects.get_or_create
+
+        def mark_submitted(**kwargs):
+            DataSourceMember.objects.update(last_submitted=submitted)
+            return get_or_create(**kwargs)
+
+        with mock.patch.object(EndpointSync.objects, 'get_or_create',
+                               mark_submitted):
+            process_jawbone('23456789')
+        jawbone_member = DataSourceMember.objects.get(
+            jawbone_id='xid-new_jawbone_access_token')
+        self.assertEqual(jawbone_member.last_submitted, submitted)
+        self.assertGreater(jawbone_member.last_updated,
+                           arrow.get('2016-06-19'))
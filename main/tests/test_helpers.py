@@ -0,0 +1,55 @@
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase
+from freezegun import freeze_time
+from open_humans.models import OpenHumansMember
+from main.helpers import (get_jawbone_files, get_url_expiry,
+                          invalidate_jawbone_files)
+
+MEMBER_DATA = {
+    'data': [{'download_url': ('https://s3.amazonaws.com/oh/jawbone.json?'
+                               'X-Amz-Date=20160624T000000Z&'
+                               'X-Amz-Expires=3600&X-Amz-Signature=x'),
+              'basename': 'jawbone-moves-data.json',
+              'metadata': {'tags': ['Jawbone', 'steps']}},
+             {'download_url': 'https://s3.amazonaws.com/oh/other.json',
+              'basename': 'other.json',
+              'metadata': {'tags': ['other']}}],
+    'next': None}
+
+
+class JawboneFilesTestCase(TestCase):
+    """
+    test that the dashboard's file listing is cached
+    """
+
+    def setUp(self):
+        self.oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="new_oh_access_token",
+                            refresh_token="new_oh_refresh_token",
+                            expires_in=36000)
+        self.oh_member.save()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_get_url_expiry(self):
+        self.assertEqual(
+            get_url_expiry(MEMBER_DATA['data'][0]['download_url']),
+            1466726400 + 3600)
+        self.assertEqual(
+            get_url_expiry('https://s3.amazonaws.com/oh/a.json?Expires=123'),
+            123)
+        self.assertIsNone(get_url_expiry(MEMBER_DATA['data'][1]['download_url']))
+
+    @freeze_time('2016-06-24')
+    @mock.patch('main.helpers.exchange_member', return_value=MEMBER_DATA)
+    def test_get_jawbone_files(self, exchange_member):
+        files = get_jawbone_files(self.oh_member)
+        self.assertEqual([f['name'] for f in files], ['jawbone-moves-data.json'])
+        self.assertEqual(get_jawbone_files(self.oh_member), files)
+        self.assertEqual(exchange_member.call_count, 1)
+        invalidate_jawbone_files(self.oh_member.oh_id)
+        get_jawbone_files(self.oh_member)
+        self.assertEqual(exchange_member.call_count, 2)
@@ -0,0 +1,51 @@
+import socket
+from django.test import TestCase, override_settings
+from datauploader import metrics
+
+
+class MetricsTestCase(TestCase):
+    """
+    test that sync metrics are exported for Prometheus and statsd
+    """
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_render(self):
+        metrics.observe('jawbone_sync_pages', 3, endpoint='moves')
+        metrics.observe('jawbone_sync_pages', 70000, endpoint='moves')
+        metrics.increment('jawbone_syncs_total', result='ok')
+        with metrics.timer('clean', 'moves'):
+            pass
+        text = metrics.render()
+        self.assertIn('# TYPE jawbone_sync_pages histogram\n', text)
+        self.assertIn(
+            'jawbone_sync_pages_bucket{endpoint="moves",le="2"} 0\n', text)
+        self.assertIn(
+            'jawbone_sync_pages_bucket{endpoint="moves",le="5"} 1\n', text)
+        self.assertIn(
+            'jawbone_sync_pages_bucket{endpoint="moves",le="+Inf"} 2\n', text)
+        self.assertIn('jawbone_sync_pages_sum{endpoint="moves"} 70003\n',
+                      text)
+        self.assertIn('jawbone_sync_pages_count{endpoint="moves"} 2\n', text)
+        self.assertIn('jawbone_syncs_total{result="ok"} 1\n', text)
+        self.assertIn('jawbone_sync_stage_seconds_count'
+                      '{stage="clean",endpoint="moves"} 1\n', text)
+
+    def test_stopwatch(self):
+        stopwatch = metrics.Stopwatch()
+        self.assertEqual(list(stopwatch.iterate(iter([1, 2]))), [1, 2])
+        self.assertGreater(stopwatch.seconds, 0)
+
+    def test_statsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        with override_settings(STATSD_HOST='127.0.0.1',
+                               STATSD_PORT=receiver.getsockname()[1]):
+            metrics.increment('jawbone_requests_total', endpoint='moves',
+                              status=429)
+        self.assertEqual(receiver.recv(1024),
+                         b'jawbone.jawbone_requests_total.moves.429:1|c')
@@ -0,0 +1,133 @@
+import asyncio
+import uuid
+from unittest import mock
+from django.test import TestCase
+import requests
+from requests_respectful import (RespectfulRequester, RequestsRespectfulError,
+                                 RequestsRespectfulRateLimitedError)
+
+
+@mock.patch.dict('requests_respectful.respectful_requester.config',
+                 {'safety_threshold': 0})
+class AdmitTestCase(TestCase):
+    """
+    test that requests are admitted atomically across their realms and
+    that acquire waits just long enough for a slot
+    """
+
+    def setUp(self):
+        self.rr = RespectfulRequester()
+        self.realms = []
+
+    def tearDown(self):
+        self.rr.unregister_realms(self.realms)
+
+    def realm(self, max_requests, timespan):
+        # Unique names, so runs don't share a window with each other or
+        # with the live "jawbone" realm.
+        realm = 'test-{}'.format(uuid.uuid4())
+        self.rr.register_realm(realm, max_requests=max_requests,
+                               timespan=timespan)
+        self.realms.append(realm)
+        return realm
+
+    def window(self, realm):
+        return self.rr.redis.zcard(self.rr._realm_window_redis_key(realm))
+
+    def test_admit_and_deny(self):
+        realm = self.realm(max_requests=2, timespan=60)
+        self.assertEqual(self.rr.acquire([realm]), 0)
+        self.assertEqual(self.rr.acquire([realm]), 0)
+        with self.assertRaises(RequestsRespectfulRateLimitedError):
+            self.rr.acquire([realm])
+        self.assertEqual(self.window(realm), 2)
+
+    def test_all_or_nothing(self):
+        limited = self.realm(max_requests=1, timespan=60)
+        free = self.realm(max_requests=5, timespan=60)
+        self.rr.acquire([limited])
+        with self.assertRaises(RequestsRespectfulRateLimitedError) as e:
+            self.rr.acquire([free, limited])
+        self.assertIn(limited, str(e.exception))
+        self.assertNotIn(free, str(e.exception))
+        # The denied request isn't counted against the realm that had room.
+        self.assertEqual(self.window(free), 0)
+        self.assertEqual(self.window(limited), 1)
+        self.rr.acquire([free])
+        self.assertEqual(self.window(free), 1)
+
+    def test_retry_after(self):
+        realm = self.realm(max_requests=1, timespan=10)
+        self.rr.acquire([realm])
+        with self.assertRaises(RequestsRespectfulRateLimitedError) as e:
+            self.rr.acquire([realm])
+        # The slot frees up when the first request leaves the window.
+        self.assertGreater(e.exception.retry_after, 9)
+        self.assertLessEqual(e.exception.retry_after, 10)
+
+    def expire(self, realm):
+        # Stands in for sleeping until the window has room again.
+        def sleep(seconds):
+            self.rr.redis.delete(self.rr._realm_window_redis_key(realm))
+        return sleep
+
+    def test_acquire_waits_for_slot(self):
+        realm = self.realm(max_requests=1, timespan=10)
+        self.rr.acquire([realm])
+        with mock.patch('requests_respectful.respectful_requester.time.sleep',
+                        side_effect=self.expire(realm)) as sleep:
+            waited = self.rr.acquire([realm], wait=True)
+        sleep.assert_called_once_with(waited)
+        self.assertGreater(waited, 9)
+        self.assertLessEqual(waited, 10)
+        self.assertEqual(self.window(realm), 1)
+
+    def test_acquire_max_wait(self):
+        realm = self.realm(max_requests=1, timespan=10)
+        self.rr.acquire([realm])
+        with mock.patch('requests_respectful.respectful_requester.time.sleep'
+                        ) as sleep:
+            with self.assertRaises(RequestsRespectfulRateLimitedError) as e:
+                self.rr.acquire([realm], wait=True, max_wait=5)
+        sleep.assert_not_called()
+        self.assertGreater(e.exception.retry_after, 5)
+
+    def test_async_acquire(self):
+        realm = self.realm(max_requests=1, timespan=10)
+        self.rr.acquire([realm])
+        sleeps = []
+        expire = self.expire(realm)
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+            expire(seconds)
+
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch('requests_respectful.respectful_requester.'
+                            'asyncio.sleep', sleep):
+                waited = loop.run_until_complete(
+                    self.rr.async_acquire([realm]))
+        finally:
+            loop.close()
+        self.assertEqual(sleeps, [waited])
+        self.assertGreater(waited, 9)
+        self.assertEqual(self.window(realm), 1)
+
+
+class ValidateRequestFuncTestCase(TestCase):
+    """
+    test that only lambdas calling requests are accepted
+    """
+
+    def test_accepts_requests_call(self):
+        RespectfulRequester._validate_request_func(
+            lambda: requests.get('http://example.com'))
+
+    def test_rejects_other_calls(self):
+        session = requests.Session()
+        for request_func in (lambda: session.get('http://example.com'),
+                             lambda: print('http://example.com'),
+                             lambda: None):
+            with self.assertRaises(RequestsRespectfulError):
+                RespectfulRequester._validate_request_func(request_func)
@@ -0,0 +1,456 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+from unittest import skipIf
+from collections import Counter, defaultdict
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from datauploader.tasks import (merge_data, track_watermark, write_json_array,
+                                iter_json_array_items,
+                                queue_jawbone_sync, release_sync_lease,
+                                acquire_sync_lease, process_jawbone,
+                                start_sync,
+                                clean_data, compile_cleaner, DISALLOWED_DATA,
+                                collect_columns, write_npz, add_jawbone_data,
+                                np, partition_of, sync_endpoint,
+                                iter_jawbone_pages, fetch_jawbone_pages,
+                                get_jawbone_data, JawboneFetchError,
+                                PageCheckpoint)
+from main.fakes import fake_services, synthetic_history
+from requests_respectful import RequestsRespectfulRateLimitedError
+
+
+class CleanDataTestCase(TestCase):
+    """
+    test that compiled cleaners drop disallowed keys, nested ones included
+    """
+
+    def test_matches_per_key_filter(self):
+        data = [{'xid': 'a', 'place_lat': 1.0, 'title': 'x', 'place_acc': 5},
+                {'place_lon': 2.0, 'xid': 'b', 'details': {'steps': 1}},
+                {}]
+        expected = [{x: item[x] for x in item if x not in DISALLOWED_DATA}
+                    for item in data]
+        cleaned = clean_data(data)
+        self.assertEqual(cleaned, expected)
+        self.assertEqual([list(item) for item in cleaned],
+                         [list(item) for item in expected])
+        self.assertIn('place_lat', data[0])
+
+    def test_nested_keys(self):
+        clean_page = compile_cleaner(['details.tz', 'details.place.lat',
+                                      'place_name'])
+        data = [{'xid': 'a', 'place_name': 'y',
+                 'details': {'tz': 'UTC', 'steps': 1,
+                             'place': {'lat': 1.0, 'lon': 2.0}}},
+                {'xid': 'b', 'details': None}]
+        self.assertEqual(clean_page(data), [
+            {'xid': 'a', 'details': {'steps': 1, 'place': {'lon': 2.0}}},
+            {'xid': 'b', 'details': None}])
+        self.assertEqual(data[0]['details']['place']['lat'], 1.0)
+
+
+class MergeDataTestCase(TestCase):
+    """
+    test that incremental syncs are merged into existing data
+    """
+
+    def test_merge_data(self):
+        old_data = [{'xid': 'b', 'time_updated': 20, 'steps': 1},
+                    {'xid': 'a', 'time_updated': 10, 'steps': 2}]
+        new_data = [{'xid': 'c', 'time_updated': 40, 'steps': 3},
+                    {'xid': 'b', 'time_updated': 30, 'steps': 4}]
+        merged = list(merge_data(new_data, old_data))
+        self.assertEqual([item['xid'] for item in merged], ['c', 'b', 'a'])
+        self.assertEqual(merged[1]['steps'], 4)
+
+    def test_track_watermark(self):
+        data = [{'xid': 'a', 'time_updated': 10},
+                {'xid': 'b', 'time_updated': 30},
+                {'xid': 'c'}]
+        state = {'watermark': 0}
+        self.assertEqual(list(track_watermark(data, state)), data)
+        self.assertEqual(state['watermark'], 30)
+
+
+class WriteJsonArrayTestCase(TestCase):
+    """
+    test that streamed files match json.dump
+    """
+
+    def test_write_json_array(self):
+        data = [{'xid': 'a', 'title': 'caf\xe9 \u2615', 'details': {
+                    'steps': 10, 'tz': None, 'hourly': [1.5, True]}},
+                {'xid': 'b', 'details': {}}]
+        for items in [data, data[:1], []]:
+            expected = io.StringIO()
+            json.dump(items, expected)
+            streamed = io.StringIO()
+            write_json_array(iter(items), streamed)
+            self.assertEqual(streamed.getvalue(), expected.getvalue())
+
+    def test_iter_json_array_items(self):
+        data = [{'xid': 'a', 'title': 'caf\xe9 ] [', 'n': 12345},
+                1.5, 'b', [], {}]
+        text = json.dumps(data)
+        for size in (1, 3, 64):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(iter_json_array_items(chunks)), data)
+        self.assertEqual(list(iter_json_array_items(['[', ' ]'])), [])
+        for text in ('[1, 2', '[1 2]', '[1,]', '{}'):
+            with self.assertRaises(ValueError):
+                list(iter_json_array_items([text]))
+
+
+@skipIf(np is None, 'numpy is not installed')
+class ColumnarExportTestCase(TestCase):
+    """
+    test the optional .npz export of flattened time series
+    """
+
+    columns = [('xid', 'xid', 'U'),
+               ('date', 'date', 'int32'),
+               ('steps', 'details.steps', 'float32')]
+    data = [{'xid': 'a', 'date': 20140101, 'details': {'steps': 10}},
+            {'xid': 'b', 'details': {'steps': 'n/a'}},
+            {'xid': 'c', 'date': 20140103, 'details': None}]
+
+    def test_write_npz(self):
+        values = defaultdict(list)
+        self.assertEqual(
+            list(collect_columns(self.data, self.columns, values)),
+            self.data)
+        npz_file = io.BytesIO()
+        write_npz(self.columns, values, npz_file)
+        npz_file.seek(0)
+        arrays = np.load(npz_file)
+        self.assertEqual(list(arrays['xid']), ['a', 'b', 'c'])
+        self.assertEqual(arrays['date'].dtype, np.int32)
+        self.assertEqual(list(arrays['date']), [20140101, 0, 20140103])
+        self.assertEqual(arrays['steps'][0], 10)
+        self.assertTrue(np.isnan(arrays['steps'][1:]).all())
+
+    @override_settings(JAWBONE_COLUMNAR_EXPORT=True)
+    @mock.patch('datauploader.tasks.invalidate_jawbone_files')
+    @mock.patch('datauploader.tasks.delete_file')
+    @mock.patch('datauploader.tasks.upload_stream')
+    def test_add_jawbone_data(self, upload_stream, delete_file, invalidate):
+        oh_member = mock.Mock(oh_id='12345678', access_token='token')
+        uploads = {}
+        upload_stream.side_effect = lambda stream, filename, metadata, *args, \
+            **kwargs: uploads.update({filename: metadata})
+        content_hash = add_jawbone_data(oh_member, iter(self.data), 'moves')
+        self.assertEqual(sorted(uploads), ['jawbone-moves-data.json',
+                                           'jawbone-moves-data.npz'])
+        self.assertIn('npz', uploads['jawbone-moves-data.npz']['tags'])
+        upload_stream.reset_mock()
+        self.assertEqual(add_jawbone_data(oh_member, iter(self.data), 'moves',
+                                          content_hash=content_hash),
+                         content_hash)
+        upload_stream.assert_not_called()
+
+
+@override_settings(JAWBONE_PARTITIONED_FILES=True)
+@mock.patch('datauploader.tasks.invalidate_jawbone_files')
+@mock.patch('datauploader.tasks.delete_file')
+@mock.patch('datauploader.tasks.upload_stream')
+@mock.patch('datauploader.tasks.iter_jawbone_pages')
+class PartitionedFilesTestCase(TestCase):
+    """
+    test that partitioned syncs only rewrite the months that changed
+    """
+
+    def setUp(self):
+        self.oh_member = mock.Mock(oh_id='12345678', access_token='token')
+        self.uploaded = {}
+
+    def upload(self, stream, filename, metadata, *args, **kwargs):
+        self.uploaded[filename] = json.load(stream)
+
+    def sync(self, state, pages):
+        existing_files = [{'name': name, 'url': name}
+                          for name in self.uploaded]
+        with mock.patch('datauploader.tasks.get_existing_jawbone_data',
+                        lambda files, endpoint, partition: self.uploaded[
+                            'jawbone-moves-{}.json'.format(partition)]):
+            return sync_endpoint(self.oh_member, 'token', 'moves', state,
+                                 lambda: existing_files)
+
+    def test_partition_of(self, *mocks):
+        self.assertEqual(partition_of({'date': 20140513}), '2014-05')
+        self.assertEqual(partition_of({'time_created': 1466726400}),
+                         '2016-06')
+        self.assertEqual(partition_of({}), 'undated')
+
+    def test_incremental_sync(self, pages, upload_stream, delete_file,
+                              invalidate):
+        upload_stream.side_effect = self.upload
+        pages.return_value = [[
+            {'xid': 'c', 'date': 20140601, 'time_updated': 30},
+            {'xid': 'b', 'date': 20140502, 'time_updated': 20},
+            {'xid': 'a', 'date': 20140501, 'time_updated': 10}]]
+        state = self.sync({'watermark': 0, 'content_hash': '',
+                           'partitions': '{}'}, pages)
+        self.assertEqual(sorted(self.uploaded), [
+            'jawbone-moves-2014-05.json', 'jawbone-moves-2014-06.json',
+            'jawbone-moves-manifest.json'])
+        self.assertEqual(state['watermark'], 30)
+        self.assertEqual(
+            [p['partition'] for p in
+             self.uploaded['jawbone-moves-manifest.json']['partitions']],
+            ['2014-05', '2014-06'])
+
+        upload_stream.reset_mock()
+        pages.return_value = [[
+            {'xid': 'b', 'date': 20140502, 'time_updated': 40, 'steps': 1}]]
+        state = self.sync(dict(state), pages)
+        self.assertEqual(pages.call_args[1]['updated_after'], 30)
+        uploads = [c[0][1] for c in upload_stream.call_args_list]
+        self.assertEqual(uploads, ['jawbone-moves-2014-05.json',
+                                   'jawbone-moves-manifest.json'])
+        self.assertEqual(self.uploaded['jawbone-moves-2014-05.json'], [
+            {'xid': 'b', 'date': 20140502, 'time_updated': 40, 'steps': 1},
+            {'xid': 'a', 'date': 20140501, 'time_updated': 10}])
+        self.assertEqual(state['watermark'], 40)
+
+
+class PaginationTestCase(TestCase):
+    """
+    test that pages of the configured size are asked for
+    """
+
+    def test_page_size(self):
+        with fake_services() as (jawbone, open_humans):
+            history = synthetic_history(years=0.7)
+            jawbone.add_member('token', history)
+            stats = Counter()
+            with override_settings(JAWBONE_PAGE_SIZES={'moves': 100}):
+                pages = list(iter_jawbone_pages('token', 'moves',
+                                                stats=stats))
+        self.assertEqual([len(page) for page in pages], [100, 100, 56])
+        self.assertEqual(sum(pages, []), history['moves'])
+        self.assertEqual(jawbone.calls['page'], 3)
+        self.assertEqual(stats['pages'], 3)
+        self.assertEqual(stats['items'], 256)
+
+    @override_settings(JAWBONE_SHARDED_FETCH=True,
+                       JAWBONE_FETCH_WINDOW_DAYS=30,
+                       JAWBONE_FETCH_CONCURRENCY=3,
+                       JAWBONE_PAGE_SIZES={'moves': 10})
+    def test_windows(self):
+        history = synthetic_history(years=1)
+        # An item Jawbone lists in two windows is only yielded once.
+        history['moves'].insert(200, dict(history['moves'][10]))
+        with fake_services() as (jawbone, open_humans):
+            jawbone.add_member('token', history)
+            stats = Counter()
+            oldest = history['moves'][-1]['time_created']
+            with override_settings(JAWBONE_HISTORY_START=oldest - 86400):
+                pages = list(fetch_jawbone_pages('token', 'moves',
+                                                 stats=stats))
+        del history['moves'][200]
+        self.assertEqual(sum(pages, []), history['moves'])
+        # Besides the newest item and the duplicate, each item is fetched
+        # once.
+        self.assertEqual(stats['items'], len(history['moves']) + 2)
+        self.assertEqual(jawbone.calls['page'], stats['pages'])
+
+    @override_settings(JAWBONE_SHARDED_FETCH=True,
+                       JAWBONE_FETCH_WINDOW_DAYS=30,
+                       JAWBONE_FETCH_CONCURRENCY=3,
+                       JAWBONE_PAGE_SIZES={'moves': 100})
+    def test_windows_stop_at_oldest_item(self):
+        history = synthetic_history(years=1)
+        # A member who didn't wear their band for 200 days.
+        del history['moves'][50:250]
+        with fake_services() as (jawbone, open_humans), \
+                mock.patch('datauploader.tasks.iter_jawbone_pages',
+                           wraps=iter_jawbone_pages) as window_pages:
+            jawbone.add_member('token', history)
+            pages = list(fetch_jawbone_pages('token', 'moves'))
+        self.assertEqual(sum(pages, []), history['moves'])
+        # Windows back to JAWBONE_HISTORY_START would be more than 60.
+        starts = [c[1]['start_time'] for c in window_pages.call_args_list]
+        self.assertLessEqual(len(starts), 12)
+        self.assertGreater(min(starts),
+                           history['moves'][-1]['time_created'] - 4 * 30 *
+                           86400)
+
+
+@override_settings(JAWBONE_PAGE_SIZES={'moves': 100})
+class PageCheckpointTestCase(TestCase):
+    """
+    test that a failed fetch resumes after the last good page
+    """
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_error_raises(self):
+        with fake_services():
+            with self.assertRaises(JawboneFetchError) as e:
+                list(iter_jawbone_pages('unknown_token', 'moves'))
+        self.assertEqual(e.exception.status_code, 401)
+
+    def test_resume(self):
+        history = synthetic_history(years=0.7)
+        history['moves'][0]['place_lat'] = 1.0
+        checkpoint = PageCheckpoint('12345678', 'moves')
+        fetched = []
+
+        def fail_third_page(*args, **kwargs):
+            if len(fetched) == 2:
+                raise JawboneFetchError(kwargs['url'], 503)
+            fetched.append(kwargs['url'])
+            return get_jawbone_data(*args, **kwargs)
+
+        with fake_services() as (jawbone, open_humans):
+            jawbone.add_member('token', history)
+            pages = []
+            with mock.patch('datauploader.tasks.get_jawbone_data',
+                            fail_third_page):
+                with self.assertRaises(JawboneFetchError):
+                    for items in iter_jawbone_pages(
+                            'token', 'moves', checkpoint=checkpoint):
+                        pages.append(items)
+            self.assertEqual(len(pages), 2)
+            pages = list(iter_jawbone_pages('token', 'moves',
+                                            checkpoint=checkpoint))
+            self.assertEqual(jawbone.calls['page'], 3)
+            # A finished query is answered from the checkpoint alone.
+            self.assertEqual(list(iter_jawbone_pages(
+                'token', 'moves', checkpoint=checkpoint)), pages)
+            self.assertEqual(jawbone.calls['page'], 3)
+        self.assertEqual(sum(pages, []), clean_data(history['moves']))
+        checkpoint.clear()
+        self.assertEqual(checkpoint.resume({'limit': 100}), ([], None))
+
+    def test_incremental_not_kept(self):
+        history = synthetic_history(years=0.7)
+        history['moves'][0]['place_lat'] = 1.0
+        checkpoint = PageCheckpoint('12345678', 'moves')
+        with fake_services() as (jawbone, open_humans), \
+                mock.patch('datauploader.tasks.cache') as cache_mock:
+            jawbone.add_member('token', history)
+            pages = list(iter_jawbone_pages('token', 'moves', updated_after=1,
+                                            checkpoint=checkpoint))
+        self.assertEqual(sum(pages, []), clean_data(history['moves']))
+        self.assertEqual(cache_mock.method_calls, [])
+
+    def test_pages_cleaned_once(self):
+        cleaner = mock.Mock(wraps=compile_cleaner(DISALLOWED_DATA))
+        uploaded = []
+
+        def upload(oh_member, data, endpoint, content_hash=None, **kwargs):
+            uploaded.extend(data)
+            return 'hash'
+
+        history = synthetic_history(years=0.7)
+        with fake_services() as (jawbone, open_humans), \
+                mock.patch.dict('datauploader.tasks.JAWBONE_CLEANERS',
+                                {'moves': cleaner}), \
+                mock.patch('datauploader.tasks.add_jawbone_data', upload):
+            jawbone.add_member('token', history)
+            sync_endpoint(mock.Mock(oh_id='12345678'), 'token', 'moves',
+                          {'watermark': 0, 'content_hash': '',
+                           'partitions': '{}'}, lambda: [])
+            self.assertEqual(cleaner.call_count, jawbone.calls['page'])
+        self.assertEqual(sorted(uploaded, key=lambda item: item['xid']),
+                         sorted(clean_data(history['moves']),
+                                key=lambda item: item['xid']))
+
+
+class SpooledUploadTestCase(TestCase):
+    """
+    test that uploads leave no temporary files behind
+    """
+
+    def setUp(self):
+        self.oh_member = mock.Mock(oh_id='12345678', access_token='token')
+        self.data = synthetic_history(years=0.2)['moves']
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch('tempfile.tempdir', directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = directory
+
+    def test_upload(self):
+        for spool_size in (1024, 16 * 1024 * 1024):
+            with override_settings(UPLOAD_SPOOL_SIZE=spool_size), \
+                    fake_services() as (jawbone, open_humans), \
+                    mock.patch('datauploader.tasks.invalidate_jawbone_files'):
+                add_jawbone_data(self.oh_member, iter(self.data), 'moves')
+                self.assertEqual(
+                    json.loads(open_humans.member_files('token')[
+                        'jawbone-moves-data.json']), self.data)
+            self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(UPLOAD_SPOOL_SIZE=1024)
+    @mock.patch('datauploader.tasks.delete_file')
+    @mock.patch('datauploader.tasks.upload_stream')
+    def test_failed_upload(self, upload_stream, delete_file):
+        upload_stream.side_effect = Exception('upload failed')
+        with self.assertRaises(Exception):
+            add_jawbone_data(self.oh_member, iter(self.data), 'moves')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class SyncLeaseTestCase(TestCase):
+    """
+    test that duplicate sync requests are coalesced
+    """
+
+    def tearDown(self):
+        cache.clear()
+
+    @mock.patch('datauploader.tasks.process_jawbone.apply_async')
+    def test_queue_jawbone_sync(self, apply_async):
+        self.assertIsNotNone(queue_jawbone_sync('23456789', interactive=True))
+        self.assertIsNone(queue_jawbone_sync('23456789'))
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(apply_async.call_args[1]['queue'], 'interactive')
+        release_sync_lease('23456789')
+        self.assertIsNotNone(queue_jawbone_sync('23456789'))
+        self.assertEqual(apply_async.call_args[1]['queue'], 'bulk')
+
+    @mock.patch('datauploader.tasks.OpenHumansMember')
+    @mock.patch('datauploader.tasks.process_jawbone.apply_async')
+    def test_interactive_supersedes_bulk(self, apply_async, member_model):
+        queue_jawbone_sync('23456789')
+        bulk_id = apply_async.call_args[1]['task_id']
+        # The member asks while the scheduled sync waits on the bulk queue.
+        self.assertIsNotNone(queue_jawbone_sync('23456789', interactive=True))
+        self.assertEqual(apply_async.call_args[1]['queue'], 'interactive')
+        interactive_id = apply_async.call_args[1]['task_id']
+        self.assertIsNone(queue_jawbone_sync('23456789', interactive=True))
+        self.assertEqual(apply_async.call_count, 2)
+
+        # The bulk task skips once it is picked up; the lease stays held.
+        member_model.objects.get.side_effect = Exception('not skipped')
+        process_jawbone.apply(args=['23456789'], task_id=bulk_id)
+        self.assertFalse(acquire_sync_lease('23456789'))
+        process_jawbone.apply(args=['23456789'], task_id=interactive_id)
+        self.assertTrue(acquire_sync_lease('23456789'))
+
+    @mock.patch('datauploader.tasks.process_jawbone.apply_async')
+    def test_running_bulk_sync_kept(self, apply_async):
+        queue_jawbone_sync('23456789')
+        self.assertTrue(start_sync('23456789',
+                                   apply_async.call_args[1]['task_id']))
+        self.assertIsNone(queue_jawbone_sync('23456789', interactive=True))
+        self.assertEqual(apply_async.call_count, 1)
+
+    @mock.patch('datauploader.tasks.OpenHumansMember')
+    def test_lease_released_after_last_retry(self, member_model):
+        member_model.objects.get.side_effect = \
+            RequestsRespectfulRateLimitedError('limited', retry_after=1)
+        self.assertTrue(acquire_sync_lease('23456789'))
+        result = process_jawbone.apply(
+            args=['23456789'], retries=process_jawbone.max_retries)
+        self.assertIsInstance(result.result,
+                              RequestsRespectfulRateLimitedError)
+        self.assertTrue(acquire_sync_lease('23456789'))
@@ -1,9 +1,14 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 from django.test import TestCase
-from freezegun import freeze_time
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
-import vcr
-from open_humans.models import OpenHumansMember
+from open_humans.models import OpenHumansMember, access_token_cache
+from main.fakes import fake_services, synthetic_history
 from main.models import DataSourceMember
 import arrow
 from datauploader.celery import app
@@ -17,12 +22,18 @@ class ManagementTestCase(TestCase):
     def setUp(self):
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
-        settings.MOVES_CLIENT_ID = 'moves_client_id'
-        settings.MOVES_CLIENT_SECRET = 'moves_client_secret'
+        settings.JAWBONE_CLIENT_ID = 'jawbone_client_id'
+        settings.JAWBONE_CLIENT_SECRET = 'jawbone_client_secret'
+        app.conf.update(task_always_eager=True)
+        self.addCleanup(app.conf.update, task_always_eager=False)
+        self.addCleanup(cache.clear)
+        self.addCleanup(access_token_cache.clear)
+        services = fake_services({'page_size': 100})
+        self.jawbone, self.open_humans = services.__enter__()
+        self.addCleanup(services.__exit__, None, None, None)
+        self.jawbone.add_member('jawbone_access_token',
+                                synthetic_history(years=0.1))
 
-    @freeze_time('2016-06-24')
-    @vcr.use_cassette('main/tests/fixtures/import_users.yaml',
-                      record_mode='none')
     def test_import_command(self):
         self.assertEqual(len(OpenHumansMember.objects.all()),
                          0)
@@ -35,8 +46,74 @@ class ManagementTestCase(TestCase):
                          1)
         self.assertEqual(len(DataSourceMember.objects.all()),
                          1)
-        self.assertEqual(len(DataSourceMember.objects.filter(moves_id=12345678)),
-                         1)
+        self.assertEqual(len(DataSourceMember.objects.filter(
+            jawbone_id='xid-jawbone_access_token')), 1)
+        self.assertEqual(OpenHumansMember.objects.get(
+            oh_id=23456789).access_token, 'new_oh_access_token')
+        self.assertEqual(
+            sorted(self.open_humans.member_files('new_oh_access_token')),
+            ['jawbone-heartrates-data.json', 'jawbone-moves-data.json',
+             'jawbone-sleeps-data.json'])
+
+    def test_bulk_import_command(self):
+        self.jawbone.add_member('jawbone_access_token_2',
+                                synthetic_history(years=0.1, seed=1))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        infile = os.path.join(directory, 'import_list.txt')
+        with open(infile, 'w') as f:
+            f.write('23456789,old_oh_access_token,old_oh_refresh_token,'
+                    'jawbone_access_token\n'
+                    '34567890,old_oh_access_token,old_oh_refresh_token,'
+                    'revoked_jawbone_access_token\n'
+                    '45678901,old_oh_access_token,old_oh_refresh_token,'
+                    'jawbone_access_token_2\n')
+        call_command('import_users', infile=infile, delimiter=',',
+                     bulk=True, batch_size=2, spread=0)
+        self.assertEqual(
+            sorted(DataSourceMember.objects.values_list('jawbone_id',
+                                                        flat=True)),
+            ['xid-jawbone_access_token', 'xid-jawbone_access_token_2'])
+        self.assertEqual(OpenHumansMember.objects.get(
+            oh_id='45678901').access_token, 'new_oh_access_token')
+        self.assertEqual(self.jawbone.calls['user'], 2)
+        with open(infile + '.checkpoint') as f:
+            self.assertEqual(f.read().split(),
+                             ['23456789', '34567890', '45678901'])
+        # Everything is checkpointed, so running again does nothing.
+        call_command('import_users', infile=infile, delimiter=',',
+                     bulk=True)
+        self.assertEqual(self.jawbone.calls['user'], 2)
+        self.assertEqual(len(OpenHumansMember.objects.all()), 2)
+
+    @mock.patch('main.management.commands.import_users.MAX_COUNTDOWN', 15)
+    @mock.patch('main.management.commands.import_users.time')
+    @mock.patch('main.management.commands.import_users.queue_jawbone_sync')
+    @mock.patch('open_humans.models.OpenHumansMember.request_tokens')
+    def test_bulk_import_pacing(self, request_tokens, queue_jawbone_sync,
+                                time):
+        request_tokens.return_value = None
+        time.time.return_value = 1000
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        infile = os.path.join(directory, 'import_list.txt')
+        with open(infile, 'w') as f:
+            for n in range(3):
+                self.jawbone.add_member('jawbone_access_token_{}'.format(n),
+                                        synthetic_history(years=0.1))
+                f.write('2345678{0},old_oh_access_token,old_oh_refresh_token,'
+                        'jawbone_access_token_{0}\n'.format(n))
+        stderr = io.StringIO()
+        call_command('import_users', infile=infile, delimiter=',',
+                     bulk=True, spread=10, stderr=stderr)
+        # A refused refresh is reported; the tokens from the file are kept.
+        self.assertIn('refused', stderr.getvalue())
+        self.assertEqual(OpenHumansMember.objects.get(
+            oh_id='23456780').access_token, 'old_oh_access_token')
+        self.assertEqual(
+            [c[1]['countdown'] for c in queue_jawbone_sync.call_args_list],
+            [0, 10, 15])
+        time.sleep.assert_called_once_with(5)
 
 
 class UpdateTestCase(TestCase):
@@ -47,31 +124,41 @@ class UpdateTestCase(TestCase):
     def setUp(self):
         settings.OPENHUMANS_CLIENT_ID = 'oh_client_id'
         settings.OPENHUMANS_CLIENT_SECRET = 'oh_client_secret'
-        settings.MOVES_CLIENT_ID = 'moves_client_id'
-        settings.MOVES_CLIENT_SECRET = 'moves_client_secret'
+        settings.JAWBONE_CLIENT_ID = 'jawbone_client_id'
+        settings.JAWBONE_CLIENT_SECRET = 'jawbone_client_secret'
         app.conf.update(task_always_eager=True)
+        self.addCleanup(app.conf.update, task_always_eager=False)
+        self.addCleanup(cache.clear)
+        self.addCleanup(access_token_cache.clear)
+        services = fake_services({'page_size': 100})
+        self.jawbone, self.open_humans = services.__enter__()
+        self.addCleanup(services.__exit__, None, None, None)
+        self.jawbone.add_member('new_jawbone_access_token',
+                                synthetic_history(years=0.1))
         oh_member = OpenHumansMember.create(
                             oh_id=23456789,
                             access_token="new_oh_access_token",
                             refresh_token="new_oh_refresh_token",
                             expires_in=36000)
         oh_member.save()
-        moves_member = DataSourceMember(
-            moves_id=12345678,
-            access_token="new_moves_access_token",
-            refresh_token='new_moves_refresh_token',
+        jawbone_member = DataSourceMember(
+            jawbone_id='xid-new_jawbone_access_token',
+            access_token="new_jawbone_access_token",
+            refresh_token='new_jawbone_refresh_token',
             token_expires=DataSourceMember.get_expiration(
                 36000),
             last_updated=arrow.get('2016-06-19').format(),
             last_submitted=arrow.get('2016-06-19').format()
         )
-        moves_member.user = oh_member
-        moves_member.save()
+        jawbone_member.user = oh_member
+        jawbone_member.save()
 
-    @freeze_time('2016-06-24')
-    @vcr.use_cassette('main/tests/fixtures/import_users.yaml',
-                      record_mode='none')
     def test_update_command(self):
         call_command('update_data')
-        moves_member = DataSourceMember.objects.get(moves_id=12345678)
-        self.assertEqual(moves_member.last_updated, arrow.get('2016-06-24'))
+        jawbone_member = DataSourceMember.objects.get(
+            jawbone_id='xid-new_jawbone_access_token')
+        self.assertGreater(jawbone_member.last_updated,
+                           arrow.get('2016-06-19'))
+        self.assertGreater(jawbone_member.last_submitted,
+                           arrow.get('2016-06-19'))
+        self.assertEqual(self.jawbone.calls['page'], 3)
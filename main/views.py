@@ -6,9 +6,11 @@ from django.shortcuts import render, redirect
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 from .models import DataSourceMember
-from .helpers import get_jawbone_files
-from datauploader.tasks import process_jawbone
-from ohapi import api
+from .helpers import (get_jawbone_files, check_update,
+                      invalidate_jawbone_files)
+from .http import jawbone_session, openhumans_session
+from datauploader.tasks import queue_jawbone_sync
+from open_humans.direct_sharing import delete_file
 import arrow
 
 # Set up logging.
@@ -63,6 +65,8 @@ def complete(request):
             context['jawbone_url'] = jawbone_url
             return render(request, 'main/complete.html',
                           context=context)
+        # Warm the file listing the dashboard is about to show.
+        get_jawbone_files(oh_member)
         return redirect("/dashboard")
 
     logger.debug('Invalid code exchange. User returned to starting page.')
@@ -78,7 +82,7 @@ def dashboard(request):
                 logout(request)
                 return redirect("/")
             connect_url = ''
-            allow_update = True  # check_update(jawbone_member)
+            allow_update = check_update(jawbone_member)
         else:
             allow_update = False
             jawbone_member = ''
@@ -94,7 +98,8 @@ def dashboard(request):
             'jawbone_member': jawbone_member,
             'download_files': download_files,
             'connect_url': connect_url,
-            'allow_update': allow_update
+            'allow_update': allow_update,
+            'update_interval': settings.SYNC_MIN_INTERVAL // 60
         }
         return render(request, 'main/dashboard.html',
                       context=context)
@@ -105,9 +110,18 @@ def remove_jawbone(request):
     if request.method == 'POST' and request.user.is_authenticated:
         try:
             oh_member = request.user.oh_member
-            api.delete_file(oh_member.access_token,
+            # Every file a sync uploaded: each endpoint's data, its monthly
+            # and .npz files, and the manifests.
+            invalidate_jawbone_files(oh_member.oh_id)
+            files = get_jawbone_files(oh_member)
+            if files == 'error':
+                raise Exception('could not list the files of {}'.format(
+                    oh_member.oh_id))
+            for dfile in files:
+                delete_file(oh_member.access_token,
                             oh_member.oh_id,
-                            file_basename='jawbone-moves-data.json')
+                            file_basename=dfile['name'])
+            invalidate_jawbone_files(oh_member.oh_id)
             messages.info(request, 'Your Jawbone account has been removed')
             jawbone_account = request.user.oh_member.datasourcemember
             jawbone_account.delete()
@@ -124,8 +138,18 @@ def remove_jawbone(request):
 def update_data(request):
     if request.method == 'POST' and request.user.is_authenticated:
         oh_member = request.user.oh_member
-        process_jawbone.delay(oh_member.oh_id)
         jawbone_member = oh_member.datasourcemember
+        if not check_update(jawbone_member):
+            messages.info(request,
+                          ('You recently requested an update of your Jawbone '
+                           'data. Please wait a while before asking again.'))
+            return redirect('/dashboard')
+        if queue_jawbone_sync(oh_member.oh_id, interactive=True) is None:
+            messages.info(request,
+                          ('An update of your Jawbone data is already in '
+                           'progress. Reload this page in a while to find '
+                           'your data'))
+            return redirect('/dashboard')
         jawbone_member.last_submitted = arrow.now().format()
         jawbone_member.save()
         messages.info(request,
@@ -133,7 +157,7 @@ def update_data(request):
                        'It can take some minutes before the first data is '
                        'available. Reload this page in a while to find your '
                        'data'))
-        return redirect('/dashboard')
+    return redirect('/dashboard')
 
 
 def jawbone_complete(request):
@@ -149,7 +173,7 @@ def jawbone_complete(request):
 
     if jawbone_member:
         messages.info(request, "Your Jawbone account has been connected")
-        process_jawbone.delay(ohmember.oh_id)
+        queue_jawbone_sync(ohmember.oh_id, interactive=True)
         return redirect('/dashboard')
 
     logger.debug('Invalid code exchange. User returned to starting page.')
@@ -172,11 +196,14 @@ def jawbone_code_to_member(code, ohmember):
             'client_id': settings.JAWBONE_CLIENT_ID,
             'client_secret': settings.JAWBONE_CLIENT_SECRET
         }
-        req = requests.post('https://jawbone.com/auth/oauth2/token', data=data)
+        req = jawbone_session().post(
+            '{}/auth/oauth2/token'.format(settings.JAWBONE_BASE_URL),
+            data=data)
         token_data = req.json()
         if 'access_token' in token_data:
-            req = requests.get(
-                'https://jawbone.com/nudge/api/v.1.1/users/@me',
+            req = jawbone_session().get(
+                '{}/nudge/api/v.1.1/users/@me'.format(
+                    settings.JAWBONE_BASE_URL),
                 headers={'Authorization': 'Bearer {}'.format(
                     token_data['access_token'])})
             user_data = req.json()
@@ -228,7 +255,7 @@ def oh_code_to_member(code):
             '{}/complete'.format(settings.OPENHUMANS_APP_BASE_URL),
             'code': code,
         }
-        req = requests.post(
+        req = openhumans_session().post(
             '{}/oauth2/token/'.format(settings.OPENHUMANS_OH_BASE_URL),
             data=data,
             auth=requests.auth.HTTPBasicAuth(
@@ -272,7 +299,7 @@ def oh_get_member_data(token):
     """
     Exchange OAuth2 token for member data.
     """
-    req = requests.get(
+    req = openhumans_session().get(
         '{}/api/direct-sharing/project/exchange-member/'
         .format(settings.OPENHUMANS_OH_BASE_URL),
         params={'access_token': token}
@@ -0,0 +1,101 @@
+"""
+Open Humans direct-sharing API calls, made through the pooled Open Humans
+session. These mirror the `ohapi.api` functions used by this app.
+"""
+import json
+import logging
+import os
+
+from django.conf import settings
+
+from main.http import openhumans_session
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_BLOCK_SIZE = 64 * 1024
+
+
+def handle_error(response, expected_code):
+    if response.status_code != expected_code:
+        raise Exception('API response status code {}:\n{}'.format(
+            response.status_code, response.content))
+
+
+def exchange_member(access_token):
+    """
+    Return member data, including all shared data files.
+    """
+    session = openhumans_session()
+    response = session.get(
+        '{}/project/exchange-member/'.format(settings.OH_API_BASE),
+        params={'access_token': access_token})
+    handle_error(response, 200)
+    member_data = response.json()
+    next_page = member_data['next']
+    while next_page:
+        response = session.get(next_page)
+        handle_error(response, 200)
+        page = response.json()
+        member_data['data'].extend(page['data'])
+        next_page = page['next']
+    return member_data
+
+
+def delete_file(access_token, project_member_id, file_basename):
+    response = openhumans_session().post(
+        settings.OH_DELETE_FILES,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'file_basename': file_basename})
+    handle_error(response, 200)
+    return response
+
+
+class SizedStream(object):
+    """
+    The rest of a seekable file object, with its length so requests sends
+    a Content-Length. requests would otherwise call fileno() to find the
+    length, which moves a SpooledTemporaryFile from memory to disk.
+    """
+
+    def __init__(self, stream):
+        position = stream.tell()
+        self.length = stream.seek(0, os.SEEK_END) - position
+        stream.seek(position)
+        self.stream = stream
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.stream.read(UPLOAD_BLOCK_SIZE), b'')
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def upload_stream(stream, filename, metadata, access_token,
+                  project_member_id):
+    """
+    Upload a file object (opened in binary mode) with the "direct upload"
+    feature.
+    """
+    session = openhumans_session()
+    response = session.post(
+        settings.OH_DIRECT_UPLOAD,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'metadata': json.dumps(metadata),
+              'filename': filename})
+    handle_error(response, 201)
+    upload_info = response.json()
+    response = session.put(upload_info['url'], data=SizedStream(stream))
+    handle_error(response, 200)
+    response = session.post(
+        settings.OH_DIRECT_UPLOAD_COMPLETE,
+        params={'access_token': access_token},
+        data={'project_member_id': project_member_id,
+              'file_id': upload_info['id']})
+    handle_error(response, 200)
+    logger.info('Upload complete: {}'.format(filename))
+    return response
@@ -1,11 +1,16 @@
+from contextlib import contextmanager
 from datetime import timedelta
+import time
 
 import arrow
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
 import requests
 
+from main.http import openhumans_session
+
 OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
 OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
@@ -33,7 +38,103 @@ def make_unique_username(base):
             return name
 
 
-class OpenHumansMember(models.Model):
+# Access tokens recently read or refreshed by this process, so hot paths
+# don't go back to the database for ACCESS_TOKEN_CACHE_TTL seconds:
+# {(model label, pk): (token, expires, cached at)}.
+access_token_cache = {}
+
+
+@contextmanager
+def token_refresh_lock(key):
+    """
+    Hold a lock shared by all processes (through the cache) while tokens
+    are refreshed. Gives up waiting after TOKEN_REFRESH_LOCK_WAIT seconds,
+    yielding False, in which case the caller mustn't refresh.
+    """
+    deadline = time.time() + settings.TOKEN_REFRESH_LOCK_WAIT
+    acquired = cache.add(key, True, settings.TOKEN_REFRESH_LOCK_TIMEOUT)
+    while not acquired and time.time() < deadline:
+        time.sleep(0.1)
+        acquired = cache.add(key, True, settings.TOKEN_REFRESH_LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(key)
+
+
+class TokenRefreshMixin(object):
+    """
+    Coalesce OAuth2 token refreshes of a member.
+
+    A refresh invalidates the old refresh token, so concurrent refreshes of
+    one member would break each other. Only the holder of the member's
+    refresh lock refreshes; everyone else waits and reuses its tokens.
+    Models using this provide `access_token`, `token_expires` and
+    `_refresh_tokens`.
+    """
+
+    def _access_token_cache_key(self):
+        return (self._meta.label, self.pk)
+
+    def _token_is_fresh(self, expires):
+        # Also refresh if nearly expired (less than 60s remaining).
+        delta = timedelta(seconds=60)
+        return arrow.get(expires) - delta >= arrow.now()
+
+    def _cache_access_token(self):
+        access_token_cache[self._access_token_cache_key()] = (
+            self.access_token, self.token_expires, time.time())
+
+    def _cached_access_token(self):
+        """
+        Return the cached access token if it is recent, still fresh and
+        belongs to the tokens this instance holds, else None.
+        """
+        cached = access_token_cache.get(self._access_token_cache_key())
+        if not cached:
+            return None
+        token, expires, cached_at = cached
+        if (time.time() - cached_at > settings.ACCESS_TOKEN_CACHE_TTL or
+                arrow.get(expires) != arrow.get(self.token_expires) or
+                not self._token_is_fresh(expires)):
+            return None
+        return token
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # New tokens (refreshed or from a new authorization) replace any
+        # this process still has.
+        access_token_cache.pop(self._access_token_cache_key(), None)
+
+    def get_fresh_access_token(self, client_id, client_secret):
+        """
+        Return access token. Refresh first if necessary.
+        """
+        cached = self._cached_access_token()
+        if cached:
+            return cached
+        if not self._token_is_fresh(self.token_expires):
+            lock_key = 'token-refresh:{}:{}'.format(
+                *self._access_token_cache_key())
+            with token_refresh_lock(lock_key) as acquired:
+                # Someone else may have refreshed while we waited.
+                self.refresh_from_db(
+                    fields=['access_token', 'refresh_token', 'token_expires'])
+                if not self._token_is_fresh(self.token_expires):
+                    if not acquired:
+                        # Refreshing alongside the lock holder would spend
+                        # the refresh token it is using.
+                        raise Exception(
+                            'timed out waiting for the token refresh of '
+                            '{}'.format(self.pk))
+                    self._refresh_tokens(client_id=client_id,
+                                         client_secret=client_secret)
+        self._cache_access_token()
+        return self.access_token
+
+
+class OpenHumansMember(TokenRefreshMixin, models.Model):
     """
     Store OAuth2 data for Open Humans member.
     A User account is created for this Open Humans member.
@@ -74,25 +175,32 @@ class OpenHumansMember(models.Model):
         """
         Return access token. Refresh first if necessary.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens(client_id=client_id,
-                                 client_secret=client_secret)
-        return self.access_token
+        return self.get_fresh_access_token(client_id=client_id,
+                                           client_secret=client_secret)
 
-    def _refresh_tokens(self, client_id, client_secret):
+    @staticmethod
+    def request_tokens(refresh_token, client_id, client_secret):
         """
-        Refresh access token.
+        Exchange a refresh token for new tokens. Return the token response,
+        or None if Open Humans refused.
         """
-        response = requests.post(
-            'https://www.openhumans.org/oauth2/token/',
+        response = openhumans_session().post(
+            '{}/oauth2/token/'.format(settings.OPENHUMANS_OH_BASE_URL),
             data={
                 'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
+                'refresh_token': refresh_token},
             auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
         if response.status_code == 200:
-            data = response.json()
+            return response.json()
+        return None
+
+    def _refresh_tokens(self, client_id, client_secret):
+        """
+        Refresh access token.
+        """
+        data = self.request_tokens(self.refresh_token, client_id,
+                                   client_secret)
+        if data:
             self.access_token = data['access_token']
             self.refresh_token = data['refresh_token']
             self.token_expires = self.get_expiration(data['expires_in'])
@@ -1,3 +1,105 @@
-from django.test import TestCase
+import time
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from .models import OpenHumansMember, access_token_cache
 
-# Create your tests here.
+
+class TokenRefreshTestCase(TestCase):
+    """
+    test that concurrent token refreshes of a member are coalesced
+    """
+
+    def setUp(self):
+        oh_member = OpenHumansMember.create(
+                            oh_id=23456789,
+                            access_token="old_oh_access_token",
+                            refresh_token="old_oh_refresh_token",
+                            expires_in=-3600)
+        oh_member.save()
+
+    def tearDown(self):
+        access_token_cache.clear()
+        cache.clear()
+
+    def test_refresh_once(self):
+        def refresh(self, client_id, client_secret):
+            self.access_token = 'new_oh_access_token'
+            self.refresh_token = 'new_oh_refresh_token'
+            self.token_expires = self.get_expiration(36000)
+            self.save()
+
+        with mock.patch.object(OpenHumansMember, '_refresh_tokens',
+                               autospec=True,
+                               side_effect=refresh) as refresh_tokens:
+            first = OpenHumansMember.objects.get(oh_id=23456789)
+            second = OpenHumansMember.objects.get(oh_id=23456789)
+            self.assertEqual(first.get_access_token(), 'new_oh_access_token')
+            self.assertEqual(second.get_access_token(), 'new_oh_access_token')
+            self.assertEqual(refresh_tokens.call_count, 1)
+
+            # A process that missed the refresh finds it after the lock.
+            access_token_cache.clear()
+            third = OpenHumansMember(
+                user=first.user, oh_id=first.oh_id,
+                access_token='old_oh_access_token',
+                refresh_token='old_oh_refresh_token',
+                token_expires=OpenHumansMember.get_expiration(-3600))
+            self.assertEqual(third.get_access_token(), 'new_oh_access_token')
+            self.assertEqual(refresh_tokens.call_count, 1)
+
+    @override_settings(TOKEN_REFRESH_LOCK_WAIT=0)
+    def test_lock_not_acquired(self):
+        cache.add('token-refresh:open_humans.OpenHumansMember:23456789',
+                  True)
+        with mock.patch.object(OpenHumansMember,
+                               '_refresh_tokens') as refresh_tokens:
+            oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+            with self.assertRaises(Exception):
+                oh_member.get_access_token()
+            refresh_tokens.assert_not_called()
+
+            # Tokens refreshed by the lock holder are used without the lock.
+            OpenHumansMember.objects.filter(oh_id=23456789).update(
+                access_token='new_oh_access_token',
+                token_expires=OpenHumansMember.get_expiration(36000))
+            self.assertEqual(oh_member.get_access_token(),
+                             'new_oh_access_token')
+            refresh_tokens.assert_not_called()
+
+    def test_new_tokens_replace_cached(self):
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        oh_member.access_token = 'old_oh_access_token'
+        oh_member.token_expires = OpenHumansMember.get_expiration(36000)
+        oh_member.save()
+        self.assertEqual(oh_member.get_access_token(), 'old_oh_access_token')
+
+        # A new authorization saved by this process.
+        oh_member.access_token = 'new_oh_access_token'
+        oh_member.token_expires = OpenHumansMember.get_expiration(72000)
+        oh_member.save()
+        self.assertEqual(
+            OpenHumansMember.objects.get(oh_id=23456789).get_access_token(),
+            'new_oh_access_token')
+
+        # ... or by another process.
+        OpenHumansMember.objects.filter(oh_id=23456789).update(
+            access_token='newer_oh_access_token',
+            token_expires=OpenHumansMember.get_expiration(36000))
+        self.assertEqual(
+            OpenHumansMember.objects.get(oh_id=23456789).get_access_token(),
+            'newer_oh_access_token')
+
+    @override_settings(ACCESS_TOKEN_CACHE_TTL=0)
+    def test_cache_expires(self):
+        oh_member = OpenHumansMember.objects.get(oh_id=23456789)
+        oh_member.access_token = 'old_oh_access_token'
+        oh_member.token_expires = OpenHumansMember.get_expiration(36000)
+        oh_member.save()
+        oh_member.get_access_token()
+        # Same expiry, new token: only the TTL retires the cached one.
+        with mock.patch('open_humans.models.time.time',
+                        return_value=time.time() + 1):
+            oh_member.access_token = 'new_oh_access_token'
+            self.assertEqual(oh_member.get_access_token(),
+                             'new_oh_access_token')
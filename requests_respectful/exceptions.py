@@ -4,7 +4,9 @@ class RequestsRespectfulError(Exception):
 
 
 class RequestsRespectfulRateLimitedError(Exception):
-    pass
+    def __init__(self, message, retry_after=None):
+        super(RequestsRespectfulRateLimitedError, self).__init__(message)
+        self.retry_after = retry_after
 
 
 class RequestsRespectfulConfigError(Exception):
@@ -20,7 +20,8 @@ default_config = {
         "database": 0
     },
     "safety_threshold": 10,
-    "requests_module_name": "requests"
+    "requests_module_name": "requests",
+    "realm_cache_ttl": 5
 }
 
 try:
@@ -43,6 +44,14 @@ try:
                 "'requests_module_name' key must be a string in 'requests-respectful.config.yml'"
             )
 
+    if "realm_cache_ttl" not in config:
+        config["realm_cache_ttl"] = default_config.get("realm_cache_ttl")
+    else:
+        if type(config["realm_cache_ttl"]) not in (int, float) or config["realm_cache_ttl"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'realm_cache_ttl' key must be a positive number in 'requests-respectful.config.yml'"
+            )
+
     if "redis" not in config:
         raise RequestsRespectfulConfigError("'redis' key is missing from 'requests-respectful.config.yml'")
 
@@ -3,8 +3,9 @@ from .exceptions import RequestsRespectfulError, RequestsRespectfulConfigError,
 
 from redis import StrictRedis, ConnectionError
 
+import asyncio
+import dis
 import uuid
-import inspect
 import time
 
 import requests
@@ -12,6 +13,49 @@ import requests
 import warnings
 
 
+# Sliding window admission, checked and recorded atomically on the server.
+# Every realm keeps a sorted set of request ids scored by request time.
+# KEYS are the realms' window keys; ARGV is a request id followed by a
+# (max_requests, timespan) pair per realm. Returns the 1-based indexes of the
+# rate-limited realms, preceded by the milliseconds until every one of them
+# has a free slot again. The request is only recorded if no realm is limited.
+ADMIT_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local result = {0}
+for i, key in ipairs(KEYS) do
+    local max_requests = tonumber(ARGV[2 * i])
+    local timespan = tonumber(ARGV[2 * i + 1])
+    redis.call("ZREMRANGEBYSCORE", key, "-inf", now - timespan)
+    local count = redis.call("ZCARD", key)
+    if count >= max_requests then
+        table.insert(result, i)
+        local wait = timespan
+        if max_requests > 0 then
+            local oldest = redis.call("ZRANGE", key, count - max_requests, count - max_requests, "WITHSCORES")
+            wait = tonumber(oldest[2]) + timespan - now
+        end
+        result[1] = math.max(result[1], math.ceil(wait * 1000))
+    end
+end
+if #result == 1 then
+    for i, key in ipairs(KEYS) do
+        redis.call("ZADD", key, now, ARGV[1])
+        redis.call("EXPIRE", key, ARGV[2 * i + 1])
+    end
+end
+return result
+"""
+
+
+# Instructions that load a name, the first ones of a request lambda tell what it calls
+NAME_LOADING_OPNAMES = ("LOAD_GLOBAL", "LOAD_NAME", "LOAD_DEREF", "LOAD_CLASSDEREF", "LOAD_FAST")
+
+# (code object, requests module name) pairs of request lambdas that passed validation
+validated_request_codes = set()
+
+
 class RespectfulRequester:
 
     def __init__(self):
@@ -22,6 +66,12 @@ class RespectfulRequester:
         except ConnectionError:
             raise RequestsRespectfulRedisError("Could not establish a connection to the provided Redis server")
 
+        self._admit_script = self.redis.register_script(ADMIT_SCRIPT)
+
+        # {realm: (max_requests, timespan)} snapshot and the time it expires
+        self._realms_cache = dict()
+        self._realms_cache_expires = 0
+
     def __getattr__(self, attr):
         if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
             return getattr(self, "_requests_proxy_%s" % attr)
@@ -32,27 +82,51 @@ class RespectfulRequester:
     def redis_prefix(self):
         return "RespectfulRequester"
 
-    def request(self, request_func, realm=None, realms=None, wait=False):
+    def request(self, request_func, realm=None, realms=None, wait=False, max_wait=None):
         if realm is not None:
             warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
             realms = [realm]
 
-        registered_realms = self.fetch_registered_realms()
+        self._validate_request_func(request_func)
+        self._validate_realms(realms)
 
-        for r in realms:
-            if r not in registered_realms:
-                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+        return self._perform_request(request_func, realms=realms, wait=wait, max_wait=max_wait)
 
-        if wait:
-            while True:
-                try:
-                    return self._perform_request(request_func, realms=realms)
-                except RequestsRespectfulRateLimitedError:
-                    pass
+    def acquire(self, realms, wait=False, max_wait=None):
+        """
+        Take a request slot on all realms and return the seconds spent waiting for it.
 
-                time.sleep(1)
-        else:
-            return self._perform_request(request_func, realms=realms)
+        With wait=True this sleeps exactly until the next slot frees up. If no slot is free
+        (or none will be within max_wait seconds) RequestsRespectfulRateLimitedError is raised;
+        its retry_after attribute tells when to try again, so callers can reschedule instead.
+        """
+        self._validate_realms(realms)
+        waited = 0
+
+        while True:
+            retry_after = self._acquire_or_retry_after(realms, wait, max_wait, waited)
+
+            if retry_after is None:
+                return waited
+
+            time.sleep(retry_after)
+            waited += retry_after
+
+    async def async_acquire(self, realms, wait=True, max_wait=None):
+        """
+        Awaitable variant of acquire() for asyncio callers.
+        """
+        self._validate_realms(realms)
+        waited = 0
+
+        while True:
+            retry_after = self._acquire_or_retry_after(realms, wait, max_wait, waited)
+
+            if retry_after is None:
+                return waited
+
+            await asyncio.sleep(retry_after)
+            waited += retry_after
 
     def fetch_registered_realms(self):
         return list(map(lambda k: k.decode("utf-8"), self.redis.smembers("%s:REALMS" % self.redis_prefix)))
@@ -61,8 +135,12 @@ class RespectfulRequester:
         redis_key = self._realm_redis_key(realm)
 
         if not self.redis.hexists(redis_key, "max_requests"):
-            self.redis.hmset(redis_key, {"max_requests": max_requests, "timespan": timespan})
-            self.redis.sadd("%s:REALMS" % self.redis_prefix, realm)
+            pipeline = self.redis.pipeline()
+            pipeline.hmset(redis_key, {"max_requests": max_requests, "timespan": timespan})
+            pipeline.sadd("%s:REALMS" % self.redis_prefix, realm)
+            pipeline.execute()
+
+            self._invalidate_realms_cache()
 
         return True
 
@@ -80,14 +158,18 @@ class RespectfulRequester:
             if updatable_key in kwargs and type(kwargs[updatable_key]) == int:
                 self.redis.hset(redis_key, updatable_key, kwargs[updatable_key])
 
+        self._invalidate_realms_cache()
+
         return True
 
     def unregister_realm(self, realm):
-        self.redis.delete(self._realm_redis_key(realm))
-        self.redis.srem("%s:REALMS" % self.redis_prefix, realm)
+        pipeline = self.redis.pipeline()
+        pipeline.delete(self._realm_redis_key(realm))
+        pipeline.srem("%s:REALMS" % self.redis_prefix, realm)
+        pipeline.delete(self._realm_window_redis_key(realm))
+        pipeline.execute()
 
-        request_keys = self.redis.keys("%s:REQUEST:%s:*" % (self.redis_prefix, realm))
-        [self.redis.delete(k) for k in request_keys]
+        self._invalidate_realms_cache()
 
         return True
 
@@ -146,6 +228,12 @@ class RespectfulRequester:
 
             config["requests_module_name"] = kwargs["requests_module_name"]
 
+        if "realm_cache_ttl" in kwargs:
+            if type(kwargs["realm_cache_ttl"]) not in (int, float) or kwargs["realm_cache_ttl"] < 0:
+                raise RequestsRespectfulConfigError("'realm_cache_ttl' key must be a positive number")
+
+            config["realm_cache_ttl"] = kwargs["realm_cache_ttl"]
+
         return config
 
     @classmethod
@@ -155,28 +243,70 @@ class RespectfulRequester:
 
         return config
 
-    def _perform_request(self, request_func, realms=None):
-        self._validate_request_func(request_func)
+    def _perform_request(self, request_func, realms=None, wait=False, max_wait=None):
+        waited = 0
+
+        while True:
+            retry_after = self._acquire_or_retry_after(realms, wait, max_wait, waited)
+
+            if retry_after is None:
+                return request_func()
 
-        rate_limited_realms = list()
+            time.sleep(retry_after)
+            waited += retry_after
+
+    def _validate_realms(self, realms):
+        registered_realms = self._cached_realms()
 
         for realm in realms:
-            if not self._can_perform_request(realm):
-                rate_limited_realms.append(realm)
+            if realm not in registered_realms:
+                # It may have been registered by another process since the last refresh
+                registered_realms = self._cached_realms(refresh=True)
+
+                if realm not in registered_realms:
+                    raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+
+    def _cached_realms(self, refresh=False):
+        # Realm settings rarely change, so they're kept in-process for 'realm_cache_ttl' seconds
+        # and fetched in one pipelined round trip. A request then only costs the admission script.
+        if refresh or time.time() >= self._realms_cache_expires:
+            realms = self.fetch_registered_realms()
+
+            pipeline = self.redis.pipeline(transaction=False)
 
-        if not len(rate_limited_realms):
             for realm in realms:
-                request_uuid = str(uuid.uuid4())
+                pipeline.hgetall(self._realm_redis_key(realm))
 
-                self.redis.setex(
-                    name="%s:REQUEST:%s:%s" % (self.redis_prefix, realm, request_uuid),
-                    time=self.realm_timespan(realm),
-                    value=request_uuid
-                )
+            realms_cache = dict()
 
-            return request_func()
-        else:
-            raise RequestsRespectfulRateLimitedError("Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms))
+            for realm, realm_info in zip(realms, pipeline.execute()):
+                if realm_info:
+                    realms_cache[realm] = (
+                        int(realm_info["max_requests".encode("utf-8")].decode("utf-8")),
+                        int(realm_info["timespan".encode("utf-8")].decode("utf-8"))
+                    )
+
+            self._realms_cache = realms_cache
+            self._realms_cache_expires = time.time() + config["realm_cache_ttl"]
+
+        return self._realms_cache
+
+    def _invalidate_realms_cache(self):
+        self._realms_cache_expires = 0
+
+    def _acquire_or_retry_after(self, realms, wait, max_wait, waited):
+        rate_limited_realms, retry_after = self._admit_request(realms)
+
+        if not len(rate_limited_realms):
+            return None
+
+        if not wait or (max_wait is not None and waited + retry_after > max_wait):
+            raise RequestsRespectfulRateLimitedError(
+                "Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms),
+                retry_after=retry_after
+            )
+
+        return retry_after
 
     def _realm_redis_key(self, realm):
         return "%s:REALMS:%s" % (self.redis_prefix, realm)
@@ -185,20 +315,24 @@ class RespectfulRequester:
         redis_key = self._realm_redis_key(realm)
         return self.redis.hgetall(redis_key)
 
-    def _requests_in_timespan(self, realm):
-        return len(
-            self.redis.scan(
-                cursor=0,
-                match="%s:REQUEST:%s:*" % (self.redis_prefix, realm),
-                count=self._redis_keys_in_db() + 100
-            )[1]
-        )
+    def _realm_window_redis_key(self, realm):
+        return "%s:WINDOW:%s" % (self.redis_prefix, realm)
+
+    def _admit_request(self, realms):
+        keys = list()
+        args = [str(uuid.uuid4())]
+
+        realms_cache = self._cached_realms()
+
+        for realm in realms:
+            max_requests, timespan = realms_cache[realm]
 
-    def _redis_keys_in_db(self):
-        return self.redis.info().get("db%d" % config["redis"]["database"]).get("keys")
+            keys.append(self._realm_window_redis_key(realm))
+            args.extend([max_requests - config["safety_threshold"], timespan])
 
-    def _can_perform_request(self, realm):
-        return self._requests_in_timespan(realm) < (self.realm_max_requests(realm) - config["safety_threshold"])
+        result = self._admit_script(keys=keys, args=args)
+
+        return [realms[i - 1] for i in result[1:]], result[0] / 1000.0
 
     # Requests proxy
     def _requests_proxy(self, method, *args, **kwargs):
@@ -213,8 +347,13 @@ class RespectfulRequester:
             raise RequestsRespectfulError("'realms' is a required kwarg")
 
         wait = kwargs.pop("wait", False)
+        max_wait = kwargs.pop("max_wait", None)
+        session = kwargs.pop("session", requests)
+
+        # The proxy builds the request function itself, so it needs no validation
+        self._validate_realms(realms)
 
-        return self.request(lambda: getattr(requests, method)(*args, **kwargs), realms=realms, wait=wait)
+        return self._perform_request(lambda: getattr(session, method)(*args, **kwargs), realms=realms, wait=wait, max_wait=max_wait)
 
     def _requests_proxy_delete(self, *args, **kwargs):
         return self._requests_proxy("delete", *args, **kwargs)
@@ -239,11 +378,25 @@ class RespectfulRequester:
 
     @staticmethod
     def _validate_request_func(request_func):
-        request_func_string = inspect.getsource(request_func)
-        post_lambda_string = request_func_string.split(":")[1].strip()
+        # Checked on the compiled code rather than the source, which may not be available
+        # (REPL, zipped or frozen deployments). Each code object is only checked once.
+        code = getattr(request_func, "__code__", None)
+        requests_module_name = config["requests_module_name"].split(".")[0]
+
+        if (code, requests_module_name) in validated_request_codes:
+            return
+
+        if code is not None:
+            loaded_names = [
+                instruction.argval for instruction in dis.get_instructions(code)
+                if instruction.opname in NAME_LOADING_OPNAMES
+            ]
+
+            if loaded_names[:1] == [requests_module_name] or loaded_names[:2] == ["getattr", "requests"]:
+                validated_request_codes.add((code, requests_module_name))
+                return
 
-        if not post_lambda_string.startswith(config["requests_module_name"]) and not post_lambda_string.startswith("getattr(requests"):
-            raise RequestsRespectfulError("The request lambda can only contain a requests function call")
+        raise RequestsRespectfulError("The request lambda can only contain a requests function call")
 
     @staticmethod
     def _config():